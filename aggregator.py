@@ -0,0 +1,221 @@
+# aggregator.py
+import bisect
+import csv
+import logging
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from metrics import LAG_BUCKETS
+from notification import parse_pubtime, topic_centre
+
+# Seconds after the end of an hour before it is evaluated for alerts (late notifications)
+CLOSE_DELAY = 900
+ALERT_TIMEOUT = 10
+
+class HourStats:
+    # Counters of one centre or station for one hour
+    __slots__ = ('received', 'duplicates', 'latency_sum', 'latency_counts')
+
+    def __init__(self):
+        self.received = 0
+        self.duplicates = 0
+        self.latency_sum = 0.0
+        self.latency_counts = [0] * (len(LAG_BUCKETS) + 1)
+
+    def add(self, duplicate, latency):
+        if duplicate:
+            self.duplicates += 1
+            return
+        self.received += 1
+        if latency is not None:
+            self.latency_sum += latency
+            self.latency_counts[bisect.bisect_left(LAG_BUCKETS, latency)] += 1
+
+def median_latency(latency_counts):
+    # Upper bound of the LAG_BUCKETS bucket holding the median, None without latencies
+    total = sum(latency_counts)
+    if total == 0:
+        return None
+    running = 0
+    for bound, count in zip(LAG_BUCKETS + (float('inf'),), latency_counts):
+        running += count
+        if running * 2 >= total:
+            return bound
+
+class AvailabilityAggregator:
+    def __init__(self, db_manager, expected=None, window_hours=3, flush_interval=60,
+                 alertmanager_url='', report_by='', availability_threshold=0.8, latency_threshold=600):
+        # Per-hour counts, duplicates and publication-to-receipt latency per centre and station,
+        # updated in O(1) per notification by the dispatcher and flushed to the database as deltas
+        # (several ingest instances add up in the same rows). The alerts are evaluated on those
+        # rows, so each instance judges the traffic of all of them, not its own share
+        self.db_manager = db_manager
+        # {wigos_station_identifier: (centre_id, reports expected per hour)}
+        self.expected = expected or {}
+        self.expected_by_centre = {}
+        for centre_id, per_hour in self.expected.values():
+            self.expected_by_centre[centre_id] = self.expected_by_centre.get(centre_id, 0) + per_hour
+        self.window_hours = int(window_hours)
+        self.flush_interval = float(flush_interval)
+        self.alertmanager_url = alertmanager_url.rstrip('/')
+        self.report_by = report_by
+        self.availability_threshold = float(availability_threshold)
+        self.latency_threshold = float(latency_threshold)
+
+        # Changes not flushed yet
+        self.pending_centres = {}
+        self.pending_stations = {}
+        self.evaluated_hours = set()
+        self.last_flush_time = time.monotonic()
+        # Hours that began before this process started were partly received by someone else
+        # (or by nobody, during a restart) and are not evaluated
+        self.start_time = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    @classmethod
+    def from_config(cls, aggregator_config, db_manager):
+        # Build an aggregator from the [Aggregator] section of general_config.ini, or None when disabled
+        if str(aggregator_config.get('Enabled', 'true')).lower() != 'true':
+            return None
+        return cls(db_manager,
+                   expected=load_expected_stations(aggregator_config.get('ExpectedStations', '')),
+                   window_hours=aggregator_config.get('WindowHours', 3),
+                   flush_interval=aggregator_config.get('FlushInterval', 60),
+                   alertmanager_url=aggregator_config.get('AlertmanagerUrl', ''),
+                   report_by=aggregator_config.get('ReportBy', 'ma-marocmeteo-global-monitor'),
+                   availability_threshold=aggregator_config.get('AvailabilityThreshold', 0.8),
+                   latency_threshold=aggregator_config.get('LatencyThreshold', 600))
+
+    def observe(self, notification, duplicate, now=None):
+        # Count one notification tuple from the subscriber (NOTIFICATION_FIELDS order)
+        topic, _, pubtime, _, _, station = notification
+        now = datetime.now(timezone.utc).replace(tzinfo=None) if now is None else now
+        published = parse_pubtime(pubtime)
+        latency = max(0.0, (now - published).total_seconds()) if published is not None else None
+        hour = (published or now).replace(minute=0, second=0, microsecond=0)
+        centre_id = topic_centre(topic)
+
+        for pending, key in ((self.pending_centres, (hour, centre_id)), (self.pending_stations, (hour, station))):
+            stats = pending.get(key)
+            if stats is None:
+                stats = pending[key] = HourStats()
+            stats.add(duplicate, latency)
+
+    def maybe_flush(self):
+        # Called from the dispatcher loop; flushes at most every flush_interval seconds
+        if time.monotonic() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self, now=None):
+        # Write the deltas since the last flush, then evaluate the hours that just closed
+        now = datetime.now(timezone.utc).replace(tzinfo=None) if now is None else now
+        self.last_flush_time = time.monotonic()
+        centre_rows = [(hour, centre_id, stats.received, stats.duplicates, self.expected_by_centre.get(centre_id, 0),
+                        stats.latency_sum, stats.latency_counts)
+                       for (hour, centre_id), stats in self.pending_centres.items()]
+        station_rows = [(hour, station, self.expected.get(station, ('', 0))[0] or None, stats.received,
+                         stats.duplicates, self.expected.get(station, ('', 0))[1], stats.latency_sum)
+                        for (hour, station), stats in self.pending_stations.items()]
+        if centre_rows or station_rows:
+            if not self.db_manager.upsert_availability(centre_rows, station_rows):
+                # The database lacks this instance's counts: evaluate once they are written
+                return
+            self.pending_centres = {}
+            self.pending_stations = {}
+
+        self.evaluate(now)
+        self.expire(now)
+
+    def availability(self, hour, station_received):
+        # {centre_id: (received expected reports, expected reports)} for one hour
+        # station_received: {(hour, wigos_station_identifier): received} from availability_hourly_station
+        report = {}
+        for station, (centre_id, per_hour) in self.expected.items():
+            received, expected = report.get(centre_id, (0, 0))
+            report[centre_id] = (received + min(station_received.get((hour, station), 0), per_hour), expected + per_hour)
+        return report
+
+    def evaluate(self, now):
+        # Raise alerts for the hours that closed since the last evaluation, from the availability
+        # tables (the counts of every ingest instance); hours older than the window are not evaluated again
+        closed = now - timedelta(seconds=CLOSE_DELAY) - timedelta(hours=1)
+        oldest = max(now - timedelta(hours=self.window_hours), self.start_time)
+        hour = oldest.replace(minute=0, second=0, microsecond=0)
+        if hour < oldest:
+            hour += timedelta(hours=1)
+        hours = []
+        while hour <= closed:
+            if hour not in self.evaluated_hours:
+                hours.append(hour)
+            hour += timedelta(hours=1)
+        if not hours:
+            return
+
+        try:
+            station_received, centre_latencies = self.db_manager.fetch_availability(hours, list(self.expected))
+        except Exception as e:
+            # Evaluated on the next flush
+            logging.error("Error reading availability: %s", e)
+            return
+        alerts = []
+        for hour in hours:
+            self.evaluated_hours.add(hour)
+            for centre_id, (received, expected) in self.availability(hour, station_received).items():
+                if expected and received / expected < self.availability_threshold:
+                    alerts.append(self.alert('LowDataAvailability', centre_id, 'warning',
+                                             f"{received}/{expected} expected reports received for {hour:%Y-%m-%d %H}h"))
+            for (latency_hour, centre_id), latency_counts in centre_latencies.items():
+                median = median_latency(latency_counts) if latency_hour == hour else None
+                if median is not None and median > self.latency_threshold:
+                    alerts.append(self.alert('HighPublicationLatency', centre_id, 'warning',
+                                             f"Median latency up to {median:.0f}s (threshold {self.latency_threshold:.0f}s) "
+                                             f"for {hour:%Y-%m-%d %H}h"))
+        if alerts:
+            self.send_alerts(alerts)
+
+    def alert(self, alertname, centre_id, severity, summary):
+        # Alertmanager API alert with the labels alertmanager_listner.py forwards
+        now = datetime.now(timezone.utc)
+        return {
+            'labels': {'alertname': alertname, 'centre_id': centre_id,
+                       'report_by': self.report_by, 'severity': severity},
+            'annotations': {'summary': summary},
+            'startsAt': now.isoformat(),
+            # Resolved automatically unless the next hour raises it again
+            'endsAt': (now + timedelta(hours=2)).isoformat()
+        }
+
+    def send_alerts(self, alerts):
+        logging.info("Aggregator raised %d alerts", len(alerts))
+        if not self.alertmanager_url:
+            return
+        # Posted from a thread so that a slow Alertmanager never holds up the dispatcher
+        threading.Thread(target=self.post_alerts, args=(alerts,), name='aggregator-alerts', daemon=True).start()
+
+    def post_alerts(self, alerts):
+        # requests is only needed here, on the alert thread
+        import requests
+        try:
+            response = requests.post(f"{self.alertmanager_url}/api/v2/alerts", json=alerts, timeout=ALERT_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.error("Error sending alerts to Alertmanager: %s", e)
+            logging.debug(traceback.format_exc())
+
+    def expire(self, now):
+        # Forget the evaluated hours that left the window
+        oldest = now - timedelta(hours=self.window_hours)
+        self.evaluated_hours = {hour for hour in self.evaluated_hours if hour >= oldest}
+
+def load_expected_stations(file_path):
+    # Read the expected stations CSV (wigos_station_identifier,centre_id,expected_per_hour)
+    if not file_path:
+        return {}
+    try:
+        with open(file_path, newline='') as csv_file:
+            return {row['wigos_station_identifier']: (row['centre_id'], int(row.get('expected_per_hour') or 1))
+                    for row in csv.DictReader(csv_file)}
+    except (OSError, KeyError, ValueError) as e:
+        logging.error("Error reading expected stations from %s: %s", file_path, e)
+        return {}
@@ -0,0 +1,239 @@
+# alert_dispatcher.py
+import json
+import logging
+import queue
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from dedup_cache import DedupCache
+
+MONITOR_ID = 'ma-marocmeteo-global-monitor'
+SEVERITY_ORDER = ['info', 'warning', 'error', 'critical']
+
+class AlertDispatcher:
+    def __init__(self, mqtt_settings, jira_settings, dispatcher_settings=None):
+        # Sends the alerts received by the webhook on a background thread:
+        # one persistent MQTT client and a pooled Jira session shared by every alert
+        dispatcher_settings = dispatcher_settings or {}
+        self.mqtt_settings = mqtt_settings
+        self.jira_url = jira_settings['url']
+        self.jira_token = jira_settings['token']
+
+        self.max_pending = int(dispatcher_settings.get('MaxPending', 1000))
+        self.group_wait = float(dispatcher_settings.get('GroupWait', 2))
+        self.qos = int(dispatcher_settings.get('QoS', 1))
+        self.jira_workers = int(dispatcher_settings.get('JiraConcurrency', 2))
+        self.jira_timeout = (float(dispatcher_settings.get('JiraConnectTimeout', 5)),
+                             float(dispatcher_settings.get('JiraReadTimeout', 30)))
+        self.jira_retries = int(dispatcher_settings.get('JiraRetries', 3))
+
+        # Alertmanager re-sends firing alerts; an alert (fingerprint) is notified once per NotificationTTL
+        # and a centre/alertname pair opens at most one Jira ticket per TicketTTL
+        self.notified = DedupCache(10000, dispatcher_settings.get('NotificationTTL', 3600))
+        self.ticketed = DedupCache(10000, dispatcher_settings.get('TicketTTL', 86400))
+        self.lock = threading.Lock()
+
+        self.pending = queue.Queue(maxsize=self.max_pending)
+        self.client = None
+        self.session = None
+        self.jira_executor = None
+        self.thread = None
+
+    def start(self):
+        self.client = self.create_mqtt_client()
+        self.session = self.create_jira_session()
+        self.jira_executor = ThreadPoolExecutor(max_workers=self.jira_workers, thread_name_prefix='jira')
+        self.thread = threading.Thread(target=self._run, name='alert-dispatcher', daemon=True)
+        self.thread.start()
+
+    def create_mqtt_client(self):
+        # Connect once and let paho reconnect in the background; QoS 1 messages published
+        # while disconnected are queued and sent after the reconnection
+        client = mqtt.Client(client_id=f"{MONITOR_ID}-alerts-{uuid.uuid4().hex[:8]}")
+        client.username_pw_set(self.mqtt_settings['username'], self.mqtt_settings['password'])
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.max_queued_messages_set(self.max_pending)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.connect_async(self.mqtt_settings['broker'], int(self.mqtt_settings['port']))
+        client.loop_start()
+        return client
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logging.info("Connected to the MQTT broker for alert notifications")
+        else:
+            logging.error(f"MQTT connection failed with code {rc}")
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            logging.warning(f"Disconnected from the MQTT broker (code {rc}), reconnecting")
+
+    def create_jira_session(self):
+        # Keep-alive connections to Jira, retrying connection errors and 429/503 responses
+        # (other errors are not retried as the ticket may already have been created)
+        retry = Retry(total=self.jira_retries, connect=self.jira_retries, read=0, backoff_factor=1,
+                      status_forcelist=[429, 503], allowed_methods=frozenset(['POST']),
+                      respect_retry_after_header=True)
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=retry, pool_maxsize=self.jira_workers))
+        session.mount('http://', HTTPAdapter(max_retries=retry, pool_maxsize=self.jira_workers))
+        session.headers.update({
+            "Authorization": f"Bearer {self.jira_token}",
+            "Content-Type": "application/json"
+        })
+        session.verify = False
+        return session
+
+    def submit(self, alerts):
+        # Queue the validated alerts of one webhook call; False when the dispatcher is saturated
+        try:
+            self.pending.put_nowait(alerts)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self, timeout=10):
+        # Send what is still queued, then disconnect
+        if self.thread is None:
+            return
+        self.pending.put(None)
+        self.thread.join(timeout)
+        self.jira_executor.shutdown(wait=True)
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.session.close()
+        self.thread = None
+
+    def _run(self):
+        running = True
+        while running:
+            alerts = self.pending.get()
+            if alerts is None:
+                break
+            # Collect the webhook calls arriving within group_wait and handle them together
+            deadline = time.monotonic() + self.group_wait
+            while True:
+                try:
+                    more = self.pending.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if more is None:
+                    running = False
+                    break
+                alerts.extend(more)
+            try:
+                self.dispatch(alerts)
+            except Exception as e:
+                logging.error(f"Error dispatching alerts: {e}")
+                logging.debug(traceback.format_exc())
+
+    def dispatch(self, alerts):
+        # One MQTT notification per new alert, one Jira ticket per new (centre_id, alertname) group
+        groups = {}
+        for alert in alerts:
+            with self.lock:
+                repeated = self.notified.seen(alert_key(alert))
+            if repeated:
+                continue
+            self.send_mqtt_notification(alert)
+            groups.setdefault((alert['centre_id'], alert['alertname']), []).append(alert)
+
+        for group_key, group in groups.items():
+            with self.lock:
+                repeated = self.ticketed.seen(group_key)
+            if repeated:
+                logging.info("Jira ticket already open for %s in %s", group_key[1], group_key[0])
+                continue
+            self.jira_executor.submit(self.create_jira_ticket_for_group, group)
+
+    def send_mqtt_notification(self, alert):
+        # Build MQTT topic with centre_id
+        centre_id = alert['centre_id']
+        mqtt_topic = f"monitor/a/wis2/{MONITOR_ID}/{centre_id}"
+
+        # Construct the JSON payload for the MQTT message
+        json_payload = {
+            "specversion": "1.0",
+            "type": "int.wmo.codes.performance",
+            "source": MONITOR_ID,
+            "subject": "some-subject",  # Adapt this as necessary
+            "id": str(uuid.uuid4()),
+            "time": alert['starts_at'],
+            "datacontenttype": "application/json",
+            "dataschema": "int.wmo.codes.event.data.v1",
+            "data": {
+                "level": alert['severity'],
+                "text": f"{alert['alertname']} in {centre_id} reported by {alert['report_by']}"
+            }
+        }
+
+        # Publish on the persistent connection; queued by paho if the broker is unreachable
+        info = self.client.publish(mqtt_topic, json.dumps(json_payload), qos=self.qos)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            logging.info(f"MQTT notification sent for {centre_id}")
+        elif info.rc == mqtt.MQTT_ERR_NO_CONN:
+            logging.warning(f"MQTT notification for {centre_id} queued until the broker is reachable")
+        else:
+            logging.error(f"Error publishing MQTT notification for {centre_id}: {mqtt.error_string(info.rc)}")
+
+    def create_jira_ticket_for_group(self, group):
+        # A single ticket for every alert of a centre/alertname pair received together
+        first = group[0]
+        severity = max((alert['severity'] for alert in group), key=severity_rank)
+        reporters = ', '.join(sorted({alert['report_by'] for alert in group}))
+        summary = f"Alert {first['alertname']} in {first['centre_id']}"
+        description = f"{first['alertname']} reported by {reporters} with a severity of {severity}."
+
+        jira_response = self.create_jira_ticket(summary, description)
+        if jira_response:
+            logging.info(f"Jira ticket created with ID {jira_response['id']}")
+        else:
+            # Let the next occurrence of the alert try again
+            with self.lock:
+                self.ticketed.forget((first['centre_id'], first['alertname']))
+
+    def create_jira_ticket(self, summary, description, issue_type="Bug"):
+        # Construct the POST request payload for Jira
+        jira_payload = {
+            "fields": {
+                "project": {
+                    "key": "WI"  #Jira project key
+                },
+                "summary": summary,
+                "description": description,
+                "issuetype": {
+                    "name": issue_type  # Bug, Task, etc.
+                }
+            }
+        }
+
+        # Send the POST request to the Jira API
+        try:
+            response = self.session.post(self.jira_url, json=jira_payload, timeout=self.jira_timeout)
+        except requests.RequestException as e:
+            logging.error(f"Error creating Jira ticket: {e}")
+            return None
+
+        # Check Jira's response
+        if response.status_code == 201:
+            logging.info("Jira ticket created successfully")
+            return response.json()
+        else:
+            logging.error(f"Error creating Jira ticket: {response.text}")
+            return None
+
+def alert_key(alert):
+    # Alertmanager identifies an alert by the fingerprint of its labels
+    return alert.get('fingerprint') or (alert['centre_id'], alert['alertname'], alert['report_by'])
+
+def severity_rank(severity):
+    return SEVERITY_ORDER.index(severity) if severity in SEVERITY_ORDER else -1
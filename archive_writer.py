@@ -0,0 +1,57 @@
+# archive_writer.py
+import logging
+import os
+import queue
+import threading
+import traceback
+
+class ArchiveWriter:
+    def __init__(self, max_pending=256):
+        # Writes downloaded payloads to the archive on a background thread,
+        # so archiving never sits between the download and the decode
+        self.max_pending = int(max_pending)
+        self.pending = None
+        self.thread = None
+        self.owner_pid = None
+        self.written = 0
+        self.errors = 0
+
+    def start(self):
+        # The thread is started lazily in the process that uses the writer
+        if self.owner_pid == os.getpid():
+            return
+        self.pending = queue.Queue(maxsize=self.max_pending)
+        self.thread = threading.Thread(target=self._run, name='archive-writer', daemon=True)
+        self.thread.start()
+        self.owner_pid = os.getpid()
+
+    def write(self, local_path, payload):
+        # Queue a payload for archiving; blocks only if the writer falls far behind
+        self.start()
+        self.pending.put((local_path, payload))
+
+    def close(self):
+        # Flush everything still queued and stop the thread
+        if self.owner_pid != os.getpid():
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.owner_pid = None
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            local_path, payload = item
+            temp_path = f"{local_path}.part"
+            try:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                with open(temp_path, 'wb') as file:
+                    file.write(payload)
+                os.replace(temp_path, local_path)
+                self.written += 1
+            except OSError as e:
+                self.errors += 1
+                logging.error("Error archiving %s: %s", local_path, e)
+                logging.debug(traceback.format_exc())
@@ -0,0 +1,219 @@
+# backfill.py
+import argparse
+import fnmatch
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+from config_reader import ConfigReader
+from database_manager import DatabaseManager
+from bufr_decoder import DecodeEngine
+from decoded_batch import BufrSchema
+
+CONFIG_DIR = 'config'
+GENERAL_CONFIG_FILE = 'general_config.ini'
+BUFR_KEYS_FILE = 'BUFRKeys.ini'
+DEFAULT_INDEX = os.path.join('backfill', 'index.db')
+DATE_FORMAT = '%Y%m%d'
+
+# Re-decodes the archive written under DownloadDirectory/<topic>/<YYYYMMDD>/ and replaces the
+# bufr rows of the matching messages, e.g. after adding keys to BUFRKeys.ini. Files are decoded
+# across a process pool, loaded a chunk at a time, and recorded in a SQLite index (size, mtime,
+# hash and the key list they were decoded with) so an interrupted run resumes where it stopped.
+
+class FileIndex:
+    def __init__(self, path):
+        # Files already loaded, with what they were decoded with
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha1 TEXT NOT NULL,
+                keys_hash TEXT NOT NULL,
+                message_id INTEGER,
+                rows INTEGER NOT NULL,
+                processed_at TEXT NOT NULL
+            )""")
+        self.db.commit()
+
+    def is_done(self, path, stat, keys_hash):
+        # True if the file was loaded with the same keys and has not changed since
+        # (the hash is only computed when size or mtime differ, e.g. after a copy)
+        row = self.db.execute("SELECT size, mtime, sha1, keys_hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None or row[3] != keys_hash:
+            return False
+        size, mtime, sha1, _ = row
+        if size == stat.st_size and mtime == stat.st_mtime:
+            return True
+        if size == stat.st_size and sha1 == file_hash(path):
+            self.db.execute("UPDATE files SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+            return True
+        return False
+
+    def record(self, entries, keys_hash):
+        # Checkpoint a loaded chunk: (path, stat, message_id, rows) tuples
+        now = datetime.utcnow().isoformat()
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(path, stat.st_size, stat.st_mtime, file_hash(path), keys_hash, message_id, rows, now)
+                             for path, stat, message_id, rows in entries])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def keys_fingerprint(keys):
+    return hashlib.sha1('\n'.join(keys).encode()).hexdigest()
+
+def archive_days(download_directory, start, end, topic_patterns):
+    # Yield (topic, day, directory) for every archived day in [start, end], in date then topic order
+    days = {}
+    for directory, subdirectories, _ in os.walk(download_directory):
+        name = os.path.basename(directory)
+        if len(name) != 8 or not name.isdigit():
+            continue
+        # Day directories hold the files, nothing below them is part of the archive layout
+        subdirectories[:] = []
+        try:
+            day = datetime.strptime(name, DATE_FORMAT).date()
+        except ValueError:
+            continue
+        topic = os.path.relpath(os.path.dirname(directory), download_directory).replace(os.sep, '/')
+        if not start <= day <= end:
+            continue
+        if topic_patterns and not any(fnmatch.fnmatch(topic, pattern) for pattern in topic_patterns):
+            continue
+        days.setdefault(day, []).append((topic, directory))
+    for day in sorted(days):
+        for topic, directory in sorted(days[day]):
+            yield topic, day, directory
+
+class Backfill:
+    def __init__(self, args):
+        general_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'General')
+        self.download_directory = args.archive or general_config['DownloadDirectory']
+        self.start = datetime.strptime(args.start, DATE_FORMAT).date()
+        self.end = datetime.strptime(args.end, DATE_FORMAT).date() if args.end else self.start
+        self.topics = args.topic
+        self.chunk_size = args.chunk_size
+        self.force = args.force
+        self.dry_run = args.dry_run
+
+        self.schema = BufrSchema.load(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE))
+        self.keys_hash = keys_fingerprint(self.schema.keys)
+        self.index = FileIndex(args.index)
+        self.db_manager = DatabaseManager()
+        self.decode_engine = DecodeEngine(args.workers)
+
+        self.stats = {'files': 0, 'skipped': 0, 'orphans': 0, 'errors': 0, 'loaded': 0, 'rows': 0}
+        self.start_time = time.monotonic()
+
+    def run(self):
+        try:
+            for topic, day, directory in archive_days(self.download_directory, self.start, self.end, self.topics):
+                self.backfill_day(topic, day, directory)
+        finally:
+            self.decode_engine.close()
+            self.db_manager.close()
+            self.index.close()
+        self.log_progress()
+        return self.stats
+
+    def backfill_day(self, topic, day, directory):
+        # Decode and load the files of one topic and day, a chunk at a time
+        pending = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith('.part') or not os.path.isfile(path):
+                continue
+            self.stats['files'] += 1
+            stat = os.stat(path)
+            if not self.force and self.index.is_done(path, stat, self.keys_hash):
+                self.stats['skipped'] += 1
+                continue
+            pending.append((name, path, stat))
+
+        if not pending:
+            return
+        logging.info("%s %s: %d files to decode", topic, day.strftime(DATE_FORMAT), len(pending))
+
+        messages = self.db_manager.find_archived_messages(topic, datetime.combine(day, datetime.min.time()))
+        for chunk_start in range(0, len(pending), self.chunk_size):
+            self.load_chunk(pending[chunk_start:chunk_start + self.chunk_size], messages)
+            self.log_progress()
+
+    def load_chunk(self, chunk, messages):
+        # Decode a chunk across the pool, replace the bufr rows of its messages and checkpoint it
+        matched = []
+        for name, path, stat in chunk:
+            message = messages.get(name)
+            if message is None:
+                # Archived file without a message row (e.g. older than the message retention)
+                self.stats['orphans'] += 1
+                continue
+            matched.append((path, stat, message))
+
+        decoded_batch = []
+        checkpoint = []
+        results = self.decode_engine.decode_files([path for path, _, _ in matched], self.schema)
+        for (path, stat, (message_id, publication_timestamp)), (decoded_data, error) in zip(matched, results):
+            if error is not None:
+                self.stats['errors'] += 1
+                logging.error("Error decoding %s: %s", path, error)
+                continue
+            decoded_batch.append((message_id, publication_timestamp, decoded_data))
+            checkpoint.append((path, stat, message_id, decoded_data.row_count))
+
+        expected_rows = sum(rows for _, _, _, rows in checkpoint)
+        if self.dry_run:
+            self.stats['loaded'] += len(checkpoint)
+            self.stats['rows'] += expected_rows
+            return
+
+        inserted = self.db_manager.insert_bufr_batch(decoded_batch, replace=True) if decoded_batch else 0
+        if inserted != expected_rows:
+            # Not checkpointed: the chunk is decoded and loaded again on the next run
+            self.stats['errors'] += len(checkpoint)
+            logging.error("Loading %d files failed, they will be retried", len(checkpoint))
+            return
+        self.index.record(checkpoint, self.keys_hash)
+        self.stats['loaded'] += len(checkpoint)
+        self.stats['rows'] += inserted
+
+    def log_progress(self):
+        elapsed = time.monotonic() - self.start_time
+        logging.info("Backfill: %d files seen, %d skipped, %d loaded (%d rows), %d without message, %d errors, %.1f files/s",
+                     self.stats['files'], self.stats['skipped'], self.stats['loaded'], self.stats['rows'],
+                     self.stats['orphans'], self.stats['errors'], self.stats['loaded'] / elapsed if elapsed > 0 else 0.0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-decode the BUFR archive and refill the bufr table")
+    parser.add_argument('--start', required=True, help="First day to reprocess (YYYYMMDD)")
+    parser.add_argument('--end', help="Last day to reprocess (YYYYMMDD, default: --start)")
+    parser.add_argument('--topic', action='append', default=[],
+                        help="Topic pattern (fnmatch, e.g. 'wis2/fr-*/*'), may be repeated; default: all topics")
+    parser.add_argument('--archive', help="Archive root (default: DownloadDirectory from general_config.ini)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Decode processes (default: all cores)")
+    parser.add_argument('--chunk-size', type=int, default=500, help="Files decoded and loaded per transaction")
+    parser.add_argument('--index', default=DEFAULT_INDEX, help="Checkpoint index of the files already loaded")
+    parser.add_argument('--force', action='store_true', help="Reprocess files already in the index")
+    parser.add_argument('--dry-run', action='store_true', help="Decode only, without writing to the database")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    Backfill(args).run()
+
+if __name__ == "__main__":
+    main()
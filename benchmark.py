@@ -0,0 +1,615 @@
+# benchmark.py
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from config_reader import ConfigReader
+from database_manager import DatabaseManager
+from decoded_batch import BufrSchema
+
+CONFIG_DIR = 'config'
+GENERAL_CONFIG_FILE = 'general_config.ini'
+MQTT_CONFIG_FILE = 'mqtt_config.ini'
+DEFAULT_CORPUS = os.path.join('benchmarks', 'corpus')
+NOTIFICATIONS_FILE = 'notifications.jsonl'
+FILES_DIR = 'files'
+
+# Entry points and modules whose import time the startup benchmark tracks,
+# and the heavy libraries it reports as loaded by each of them
+STARTUP_MODULES = ('data_processor', 'mqtt_subscriber', 'backfill', 'alertmanager_listner', 'aggregator',
+                   'database_manager', 'bufr_decoder', 'notification')
+HEAVY_MODULES = ('eccodes', 'psycopg2', 'requests', 'paho', 'pyarrow', 'flask', 'numpy')
+
+IMPORT_PROBE = """
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+print(json.dumps({{'seconds': elapsed, 'loaded': sorted(name for name in {heavy!r} if name in sys.modules)}}))
+"""
+
+# First decode of a file in a fresh process: without preloading, and in a process forked
+# after preload_eccodes (as the batch workers are)
+DECODE_PROBE = """
+import json, os, time
+import bufr_decoder
+from decoded_batch import BufrSchema
+schema = BufrSchema.load({keys_file!r})
+with open({path!r}, 'rb') as bufr_file:
+    payload = bufr_file.read()
+result = {{}}
+if {preload!r}:
+    start_time = time.perf_counter()
+    bufr_decoder.preload_eccodes(schema)
+    result['preload_seconds'] = time.perf_counter() - start_time
+    read_end, write_end = os.pipe()
+    if os.fork() == 0:
+        start_time = time.perf_counter()
+        bufr_decoder.decode_columns(payload, schema)
+        os.write(write_end, repr(time.perf_counter() - start_time).encode())
+        os._exit(0)
+    os.close(write_end)
+    result['first_decode_seconds'] = float(os.read(read_end, 64))
+    os.wait()
+else:
+    start_time = time.perf_counter()
+    bufr_decoder.decode_columns(payload, schema)
+    result['first_decode_seconds'] = time.perf_counter() - start_time
+start_time = time.perf_counter()
+bufr_decoder.decode_columns(payload, schema)
+result['warm_decode_seconds'] = time.perf_counter() - start_time
+print(json.dumps(result))
+"""
+
+# A corpus is a directory holding notifications.jsonl (one {"topic", "payload"} object
+# per line, payload being the notification exactly as received) and files/ with the
+# BUFR file of every notification, named after the basename of its canonical link
+
+class Stage:
+    def __init__(self, name):
+        # Latency samples and counters collected while a pipeline stage runs
+        self.name = name
+        self.latencies = []
+        self.items = 0
+        self.elapsed = 0.0
+        self.extra = {}
+        self.peak_allocated = None
+        self.max_rss_kb = None
+
+    def time(self, function, *args, items=1):
+        start_time = time.perf_counter()
+        result = function(*args)
+        self.latencies.append(time.perf_counter() - start_time)
+        self.items += items
+        return result
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        elapsed = sum(latencies)
+        report = {
+            'calls': len(latencies),
+            'items': self.items,
+            'seconds': round(elapsed, 6),
+            'items_per_second': round(self.items / elapsed, 1) if elapsed > 0 else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            'max_rss_kb': self.max_rss_kb
+        }
+        if self.peak_allocated is not None:
+            report['peak_allocated_kb'] = round(self.peak_allocated / 1024, 1)
+        report.update(self.extra)
+        return report
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+@contextmanager
+def measure(stage, trace_memory):
+    # Record the peak Python allocation (optional, tracemalloc is slow) and process RSS of a stage
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        yield stage
+    finally:
+        if trace_memory:
+            stage.peak_allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stage.max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class RecordingCursor:
+    def __init__(self, recorder, connection):
+        # Stand-in for a psycopg2 cursor: statements are counted, never executed
+        self.recorder = recorder
+        self.connection = connection
+        self.pending_rows = []
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def mogrify(self, template, args):
+        self.pending_rows.append(args)
+        return repr(tuple(args)).encode()
+
+    def execute(self, query, args=None):
+        query = query if isinstance(query, bytes) else query.encode()
+        self.recorder.round_trips += 1
+        self.recorder.rows += len(self.pending_rows)
+        if b'INSERT INTO message' in query and b'RETURNING' in query:
+            # Hand out ids the way the message table would: (id, data_id, publication_timestamp)
+            self.result = []
+            for row in self.pending_rows:
+                self.recorder.last_id += 1
+                self.result.append((self.recorder.last_id, row[2], row[1]))
+        self.pending_rows = []
+
+    def fetchall(self):
+        result, self.result = self.result, []
+        return result
+
+class RecordingConnection:
+    encoding = 'UTF8'
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def cursor(self):
+        return RecordingCursor(self.recorder, self)
+
+class RecordingDatabase(DatabaseManager):
+    def __init__(self):
+        # DatabaseManager whose connections only count round trips and rows
+        super().__init__()
+        self.round_trips = 0
+        self.rows = 0
+        self.connections = 0
+        self.last_id = 0
+
+    @contextmanager
+    def connection(self):
+        self.connections += 1
+        yield RecordingConnection(self)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@contextmanager
+def file_server(directory):
+    # Serve the corpus files over HTTP on a free local port
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class ListQueue(list):
+    # Collects what the subscriber queues, without a process boundary
+    def put(self, item):
+        self.append(item)
+
+class ReplayMessage:
+    def __init__(self, topic, payload):
+        # Minimal stand-in for paho's MQTTMessage
+        self.topic = topic
+        self.payload = payload
+
+def load_corpus(corpus, base_url):
+    # Read the recorded notifications, pointing their canonical links at the local file server
+    messages = []
+    with open(os.path.join(corpus, NOTIFICATIONS_FILE)) as notifications:
+        for line in notifications:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            data = json.loads(record['payload'])
+            for link in data.get('links', []):
+                if link.get('rel') == 'canonical':
+                    link['href'] = f"{base_url}/{os.path.basename(urlsplit(link['href']).path)}"
+            messages.append(ReplayMessage(record['topic'], json.dumps(data).encode()))
+    return messages
+
+def batches(items, size):
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+def run_benchmark(args):
+    from bufr_manager import BufrFileManager
+    from data_processor import DataProcessor
+    from mqtt_subscriber import MqttSubscriber
+
+    general_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'General')
+    mqtt_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, MQTT_CONFIG_FILE), general_config['GS'])
+    files_directory = os.path.join(args.corpus, FILES_DIR)
+
+    stages = {}
+    with file_server(files_directory) as base_url:
+        messages = load_corpus(args.corpus, base_url) * args.repeat
+
+        # Subscriber: on_message fed in-process, as paho would call it
+        queued = ListQueue()
+        subscriber = MqttSubscriber(general_config['GS'], mqtt_config, queued)
+        stage = stages['subscriber'] = Stage('subscriber')
+        with measure(stage, args.trace_memory):
+            for message in messages:
+                stage.time(subscriber.on_message, None, None, message)
+        stage.extra['dropped'] = {reason: child.value for reason, child in subscriber.dropped.items()}
+
+        processor = DataProcessor(None)
+        if args.database == 'fake':
+            processor.db_manager = RecordingDatabase()
+        else:
+            processor.db_manager = DatabaseManager()
+        processor.bufr_manager = BufrFileManager(processor.db_manager)
+        processor.bufr_manager.archive_downloads = False
+        schema = BufrSchema.load(os.path.join(CONFIG_DIR, 'BUFRKeys.ini'))
+
+        # Dispatcher dedup, then per-message parsing in the worker
+        stage = stages['dedup'] = Stage('dedup')
+        unique = []
+        with measure(stage, args.trace_memory):
+            for notification in queued:
+                if stage.time(processor.is_new, notification):
+                    unique.append(notification)
+        stage.extra['duplicates'] = processor.dedup_cache.hits
+
+        stage = stages['prepare'] = Stage('prepare')
+        prepared = []
+        with measure(stage, args.trace_memory):
+            for notification in unique:
+                message = stage.time(processor.prepare_message, notification)
+                if message is not None:
+                    prepared.append(message)
+
+        # Downloads, one at a time for latency and per batch for throughput
+        urls = [message.canonical_url for message in prepared]
+        downloader = processor.bufr_manager.downloader
+        stage = stages['download'] = Stage('download')
+        payloads = []
+        with measure(stage, args.trace_memory):
+            for url in urls:
+                payloads.append(stage.time(downloader.fetch, url))
+        stage = stages['download_batch'] = Stage('download_batch')
+        with measure(stage, args.trace_memory):
+            for batch in batches(urls, processor.scheduler.batch_size):
+                stage.time(downloader.fetch_many, batch, items=len(batch))
+
+        # Decoding, per file
+        decode_engine = processor.bufr_manager.decode_engine
+        stage = stages['decode'] = Stage('decode')
+        decoded = []
+        with measure(stage, args.trace_memory):
+            for payload in payloads:
+                decoded.append(stage.time(decode_engine.decode_many, [payload], schema)[0][0])
+        stage.extra['rows'] = sum(result.row_count for result in decoded if result is not None)
+
+        # Database writes, per processor batch
+        db_manager = processor.db_manager
+        stage = stages['database'] = Stage('database')
+        with measure(stage, args.trace_memory):
+            for batch in batches(list(zip(prepared, decoded)), processor.scheduler.batch_size):
+                def write_batch(batch=batch):
+                    message_ids = db_manager.insert_messages([message for message, _ in batch])
+                    db_manager.insert_bufr_batch([(message_id, message.publication_timestamp, result)
+                                                  for message_id, (message, result) in zip(message_ids, batch)
+                                                  if message_id is not None and result is not None])
+                stage.time(write_batch, items=len(batch))
+        if isinstance(db_manager, RecordingDatabase):
+            stage.extra['round_trips'] = db_manager.round_trips
+            stage.extra['rows'] = db_manager.rows
+            stage.extra['round_trips_per_message'] = round(db_manager.round_trips / max(1, len(prepared)), 3)
+
+        # Whole worker path: process_batch on the queued notifications
+        if isinstance(db_manager, RecordingDatabase):
+            db_manager.round_trips = db_manager.rows = 0
+        stage = stages['process_batch'] = Stage('process_batch')
+        with measure(stage, args.trace_memory):
+            for batch in batches(unique, processor.scheduler.batch_size):
+                stage.time(processor.process_batch, batch, items=len(batch))
+        if isinstance(db_manager, RecordingDatabase):
+            stage.extra['round_trips'] = db_manager.round_trips
+
+        processor.bufr_manager.close()
+
+    return {
+        'benchmark': 'pipeline',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'corpus': args.corpus,
+        'messages': len(messages),
+        'database': args.database,
+        'stages': {name: stage.report() for name, stage in stages.items()}
+    }
+
+def legacy_prepare(payload):
+    # The per-message parsing of DataProcessor.prepare_message before notification.py,
+    # kept as the baseline of the parse benchmark
+    topic, _, publication_timestamp, data_id, canonical_url, wigos_station_identifier = payload
+    topic_pattern = re.compile(r'wis2/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/synop')
+    match = topic_pattern.search(topic)
+    topic = match.group(0) if match else 'N/A'
+    not_allowed_extensions = ['.png', '.jpeg', '.jpg']
+    if any(canonical_url.lower().endswith(ext) for ext in not_allowed_extensions):
+        return None
+    publication_timestamp_obj = datetime.strptime(publication_timestamp, "%Y-%m-%dT%H:%M:%SZ") if '.' not in publication_timestamp else datetime.strptime(publication_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    constructed_link = f"{topic}/{publication_timestamp_obj.strftime('%Y%m%d')}"
+    return [{
+        'topic': topic,
+        'publication_timestamp': publication_timestamp_obj,
+        'data_id': data_id,
+        'canonical_url': canonical_url,
+        'wigos_station_identifier': wigos_station_identifier
+    }], constructed_link
+
+def parse_benchmark(args):
+    # Per-message cost of turning a received notification into a stored record:
+    # compact_notification on the decoded JSON, then the old and new message parsing
+    from notification import compact_notification, parse_message
+
+    messages = load_corpus(args.corpus, 'http://localhost')
+    decoded = [(message.topic, json.loads(message.payload)) for message in messages]
+    notifications = [compact_notification(topic, data) for topic, data in decoded]
+
+    def per_message(function, items):
+        # Best of args.rounds passes over the corpus, in microseconds per message
+        best = None
+        for _ in range(args.rounds):
+            start_time = time.perf_counter()
+            for _ in range(args.repeat):
+                for item in items:
+                    function(*item)
+            elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best / (len(items) * args.repeat) * 1e6, 3)
+
+    stages = {
+        'compact_notification_us': per_message(compact_notification, decoded),
+        'prepare_before_us': per_message(legacy_prepare, [(notification,) for notification in notifications]),
+        'prepare_after_us': per_message(parse_message, [(notification,) for notification in notifications])
+    }
+    stages['speedup'] = round(stages['prepare_before_us'] / stages['prepare_after_us'], 2)
+    return {
+        'benchmark': 'parse',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'corpus': args.corpus,
+        'messages': len(notifications) * args.repeat,
+        'stages': stages
+    }
+
+def run_probe(code):
+    # Run a probe in a fresh interpreter from the repository root and return its JSON output
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def startup_benchmark(args):
+    # Import time of every entry point in a fresh interpreter (median of args.runs) with the heavy
+    # libraries each one loads, and the cold-start cost of the first decode with and without preloading
+    def median_ms(samples, key):
+        return round(statistics.median(sample[key] for sample in samples) * 1000, 1)
+
+    interpreter = []
+    for _ in range(args.runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        interpreter.append(time.perf_counter() - start_time)
+
+    imports = {}
+    for module in STARTUP_MODULES:
+        samples = [run_probe(IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)) for _ in range(args.runs)]
+        imports[module] = {'import_ms': median_ms(samples, 'seconds'), 'loads': samples[-1]['loaded']}
+
+    files = sorted(os.listdir(os.path.join(args.corpus, FILES_DIR)))
+    cold_start = {}
+    if files:
+        path = os.path.abspath(os.path.join(args.corpus, FILES_DIR, files[0]))
+        keys_file = os.path.join(CONFIG_DIR, 'BUFRKeys.ini')
+        for name, preload in (('without_preload', False), ('forked_after_preload', True)):
+            samples = [run_probe(DECODE_PROBE.format(keys_file=keys_file, path=path, preload=preload))
+                       for _ in range(args.runs)]
+            cold_start[name] = {key.replace('_seconds', '_ms'): median_ms(samples, key) for key in samples[0]}
+
+    return {
+        'benchmark': 'startup',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'interpreter_ms': round(statistics.median(interpreter) * 1000, 1),
+        'imports': imports,
+        'cold_start': cold_start
+    }
+
+def record_corpus(args):
+    # Capture live notifications and their files from the configured global broker
+    import requests
+    from mqtt_subscriber import MqttSubscriber
+
+    general_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'General')
+    mqtt_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, MQTT_CONFIG_FILE), general_config['GS'])
+    files_directory = os.path.join(args.corpus, FILES_DIR)
+    os.makedirs(files_directory, exist_ok=True)
+
+    recorded = []
+    subscriber = MqttSubscriber(general_config['GS'], mqtt_config, None)
+
+    def on_message(client, userdata, msg):
+        if len(recorded) >= args.count:
+            return
+        data = json.loads(msg.payload)
+        url = next((link['href'] for link in data.get('links', []) if link.get('rel') == 'canonical'), None)
+        if url is None:
+            return
+        try:
+            response = requests.get(url, timeout=30)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.warning("Skipping %s: %s", url, e)
+            return
+        with open(os.path.join(files_directory, os.path.basename(urlsplit(url).path)), 'wb') as file:
+            file.write(response.content)
+        recorded.append({'topic': msg.topic, 'payload': msg.payload.decode()})
+        if len(recorded) >= args.count:
+            client.disconnect()
+
+    subscriber.client.on_message = on_message
+    subscriber.connect()
+
+    with open(os.path.join(args.corpus, NOTIFICATIONS_FILE), 'w') as notifications:
+        for record in recorded:
+            notifications.write(json.dumps(record) + '\n')
+    print(f"Recorded {len(recorded)} notifications in {args.corpus}")
+
+def synthesize_corpus(args):
+    # Build a synthetic corpus of SYNOP-like BUFR files and matching notifications:
+    # single-station files, multi-subset bulletins, repeated deliveries, a blacklisted
+    # centre and an image link, so every filter of the pipeline is exercised
+    import random
+    import uuid
+    import eccodes
+
+    random.seed(args.seed)
+    files_directory = os.path.join(args.corpus, FILES_DIR)
+    os.makedirs(files_directory, exist_ok=True)
+
+    def encode(stations):
+        bufr = eccodes.codes_bufr_new_from_samples('BUFR4')
+        try:
+            eccodes.codes_set(bufr, 'masterTablesVersionNumber', 38)
+            eccodes.codes_set(bufr, 'numberOfSubsets', len(stations))
+            eccodes.codes_set(bufr, 'compressedData', 1 if len(stations) > 1 else 0)
+            eccodes.codes_set_array(bufr, 'unexpandedDescriptors', [301150, 307080])
+            for key, values in (('blockNumber', [station // 1000 for station in stations]),
+                                ('stationNumber', [station % 1000 for station in stations]),
+                                ('latitude', [random.uniform(-60, 70) for _ in stations]),
+                                ('longitude', [random.uniform(-180, 180) for _ in stations]),
+                                ('pressureReducedToMeanSeaLevel', [random.randint(97000, 104000) for _ in stations])):
+                if len(stations) > 1:
+                    eccodes.codes_set_array(bufr, key, values)
+                else:
+                    eccodes.codes_set(bufr, key, values[0])
+            for key, value in (('year', 2024), ('month', 5), ('day', 1), ('hour', 12), ('minute', 0)):
+                eccodes.codes_set(bufr, key, value)
+            eccodes.codes_set(bufr, 'pack', 1)
+            return eccodes.codes_get_message(bufr)
+        finally:
+            eccodes.codes_release(bufr)
+
+    centres = [('fra', 'meteofrance'), ('mar', 'marocmeteo'), ('bra', 'inmet'), ('swe', 'smhi')]
+    records = []
+    for index in range(args.count):
+        country, centre = centres[index % len(centres)]
+        multi_subset = index % 5 == 0
+        stations = [random.randint(1000, 99999) for _ in range(20 if multi_subset else 1)]
+        file_name = f"{country}_{centre}_{index:05d}.bufr4"
+        image = index % 25 == 24
+        if image:
+            file_name = file_name.replace('.bufr4', '.png')
+        else:
+            with open(os.path.join(files_directory, file_name), 'wb') as file:
+                file.write(encode(stations))
+
+        fraction = f".{random.randint(0, 999):03d}" if index % 3 == 0 else ''
+        notification = {
+            'id': str(uuid.uuid4()),
+            'type': 'Feature',
+            'geometry': None,
+            'properties': {
+                'data_id': f"wis2/{country}-{centre}/data/core/weather/surface-based-observations/synop/{file_name}",
+                'pubtime': f"2024-05-01T12:{index // 60 % 60:02d}:{index % 60:02d}{fraction}Z",
+                'datetime': '2024-05-01T12:00:00Z',
+                'wigos_station_identifier': f"0-20000-0-{stations[0]:05d}"
+            },
+            'links': [{'rel': 'canonical', 'type': 'application/bufr',
+                       'href': f"https://cache.example.int/{country}/{centre}/{file_name}"}]
+        }
+        topic = f"cache/a/wis2/{country}/{centre}/data/core/weather/surface-based-observations/synop"
+        records.append({'topic': topic, 'payload': json.dumps(notification)})
+        if index % 10 == 3:
+            # The same notification delivered again by another cache
+            records.append({'topic': topic, 'payload': json.dumps(notification)})
+
+    with open(os.path.join(args.corpus, NOTIFICATIONS_FILE), 'w') as notifications:
+        for record in records:
+            notifications.write(json.dumps(record) + '\n')
+    print(f"Synthesized {len(records)} notifications in {args.corpus}")
+
+def write_report(report, output):
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text + '\n')
+    print(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the WIS2 ingest pipeline against local stand-ins")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Replay a recorded corpus through every pipeline stage")
+    run_parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    run_parser.add_argument('--repeat', type=int, default=1, help="Replay the corpus this many times")
+    run_parser.add_argument('--database', choices=['fake', 'config'], default='fake',
+                            help="Record statements in memory, or write to the database in database_config.ini")
+    run_parser.add_argument('--trace-memory', action='store_true', help="Report peak Python allocations per stage")
+    run_parser.add_argument('--output', help="Also write the JSON report to this file")
+
+    parse_parser = subparsers.add_parser('parse', help="Micro-benchmark notification parsing, before and after notification.py")
+    parse_parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parse_parser.add_argument('--repeat', type=int, default=100, help="Passes over the corpus per round")
+    parse_parser.add_argument('--rounds', type=int, default=5, help="Rounds to run, the fastest is reported")
+    parse_parser.add_argument('--output', help="Also write the JSON report to this file")
+
+    startup_parser = subparsers.add_parser('startup', help="Import time of the entry points and cold-start decode cost")
+    startup_parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    startup_parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per measurement, the median is reported")
+    startup_parser.add_argument('--output', help="Also write the JSON report to this file")
+
+    record_parser = subparsers.add_parser('record', help="Record live notifications and files into a corpus")
+    record_parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    record_parser.add_argument('--count', type=int, default=200)
+
+    synthesize_parser = subparsers.add_parser('synthesize', help="Generate a synthetic corpus with eccodes")
+    synthesize_parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    synthesize_parser.add_argument('--count', type=int, default=100)
+    synthesize_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == 'run':
+        write_report(run_benchmark(args), args.output)
+    elif args.command == 'parse':
+        write_report(parse_benchmark(args), args.output)
+    elif args.command == 'startup':
+        write_report(startup_benchmark(args), args.output)
+    elif args.command == 'record':
+        record_corpus(args)
+    elif args.command == 'synthesize':
+        synthesize_corpus(args)
+
+if __name__ == "__main__":
+    main()
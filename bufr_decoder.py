@@ -0,0 +1,184 @@
+# bufr_decoder.py
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from decoded_batch import DecodedBatch
+
+# eccodes is imported on first use (load_eccodes), so processes that never decode do not pay for it;
+# the ingest processor preloads it before forking its workers (preload_eccodes)
+eccodes = None
+
+# BUFR master table versions and template (WIGOS identifier + SYNOP land station) loaded by preload_eccodes
+PRELOAD_TABLE_VERSIONS = (38, 39, 40, 41)
+PRELOAD_DESCRIPTORS = [301150, 307080]
+
+def load_eccodes():
+    global eccodes
+    if eccodes is None:
+        import eccodes as module
+        eccodes = module
+    return eccodes
+
+def preload_eccodes(schema=None, table_versions=PRELOAD_TABLE_VERSIONS):
+    # Import eccodes and load its BUFR definitions and the element tables of the given master table
+    # versions in this process, so the processes forked afterwards share them instead of each
+    # loading its own copy; with a schema, the configured keys are also read once from a SYNOP sample
+    start_time = time.perf_counter()
+    load_eccodes()
+    for table_version in table_versions:
+        bufr = eccodes.codes_bufr_new_from_samples('BUFR4')
+        try:
+            eccodes.codes_set(bufr, "masterTablesVersionNumber", int(table_version))
+            eccodes.codes_set_array(bufr, "unexpandedDescriptors", PRELOAD_DESCRIPTORS)
+            eccodes.codes_set(bufr, "unpack", 1)
+            sample = eccodes.codes_get_message(bufr)
+        except eccodes.CodesInternalError as e:
+            logging.warning("Could not preload BUFR tables version %s: %s", table_version, e)
+            continue
+        finally:
+            eccodes.codes_release(bufr)
+        if schema is not None:
+            decode_columns(sample, schema)
+    logging.info("eccodes preloaded in %.3fs", time.perf_counter() - start_time)
+
+def split_bufr_messages(payload):
+    # Yield each BUFR message of a payload, using the total length from section 0
+    # (the 3 bytes after "BUFR") to jump from one message to the next
+    view = memoryview(payload)
+    position = payload.find(b'BUFR')
+    while position != -1 and position + 8 <= len(payload):
+        length = int.from_bytes(view[position + 4:position + 7], 'big')
+        if length < 8 or position + length > len(payload):
+            logging.warning("Truncated BUFR message at offset %d", position)
+            break
+        # eccodes copies the message into its own handle, so a bytes slice is passed
+        yield bytes(view[position:position + length])
+        position = payload.find(b'BUFR', position + length)
+
+def extract_column(bufr, key, subset_count):
+    # Fetch every value of a key in one call and return (values, mask) with one entry per subset
+    # Integer keys stay int64 and numeric keys float64 (strings an object array); the mask flags
+    # the CODES_MISSING_* values. None when the message does not have the key.
+    try:
+        values = eccodes.codes_get_array(bufr, key)
+    except eccodes.KeyValueNotFoundError:
+        return None
+
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind == 'f':
+            mask = (values == eccodes.CODES_MISSING_DOUBLE) | (values == eccodes.CODES_MISSING_LONG) | ~np.isfinite(values)
+        else:
+            values = values.astype(np.int64, copy=False)
+            mask = values == eccodes.CODES_MISSING_LONG
+    else:
+        values = np.array(values, dtype=object)
+        mask = np.zeros(len(values), dtype=bool)
+
+    if len(values) == subset_count:
+        return values, mask
+    if len(values) == 1:
+        # Constant across subsets (header key or compressed constant)
+        return np.repeat(values, subset_count), np.repeat(mask, subset_count)
+
+    # The key occurs several times per subset: keep the first occurrence of each subset
+    firsts = [first_value(bufr, f"/subsetNumber={subset}/{key}") for subset in range(1, subset_count + 1)]
+    mask = np.array([value is None for value in firsts], dtype=bool)
+    filler = None if values.dtype == object else 0
+    return np.array([filler if value is None else value for value in firsts], dtype=values.dtype), mask
+
+def first_value(bufr, key):
+    # Value of a key, None when it is missing
+    try:
+        value = eccodes.codes_get(bufr, key)
+    except eccodes.CodesInternalError:
+        return None
+    if value in (eccodes.CODES_MISSING_DOUBLE, eccodes.CODES_MISSING_LONG):
+        return None
+    return value
+
+def decode_columns(payload, schema):
+    # Decode every message of a BUFR payload into a DecodedBatch: one typed array and mask
+    # per schema key, one entry per subset, plus the number of the message each subset comes from
+    start_time = time.perf_counter()
+    load_eccodes()
+    subset_counts = []
+    parts = [[] for _ in schema.keys]
+
+    for message in split_bufr_messages(payload):
+        bufr = eccodes.codes_new_from_message(message)
+        try:
+            # Skipping the attributes (units, scale, ...) of every element makes unpacking cheaper
+            eccodes.codes_set(bufr, "skipExtraKeyAttributes", 1)
+            eccodes.codes_set(bufr, "unpack", 1)
+            subset_count = eccodes.codes_get(bufr, "numberOfSubsets")
+
+            for key, key_parts in zip(schema.keys, parts):
+                key_parts.append(extract_column(bufr, key, subset_count))
+            subset_counts.append(subset_count)
+        finally:
+            eccodes.codes_release(bufr)
+
+    # Measured here so it is also known when decoding ran in a pool process
+    return DecodedBatch.from_parts(schema, subset_counts, parts, time.perf_counter() - start_time)
+
+def decode_file_columns(file_path, schema):
+    # Decode a BUFR file from disk into a DecodedBatch
+    with open(file_path, 'rb') as bufr_file:
+        return decode_columns(bufr_file.read(), schema)
+
+class DecodeEngine:
+    def __init__(self, workers=0):
+        # Spread decoding over a pool of processes; 0 workers decodes in the calling process
+        self.workers = max(0, int(workers))
+        self.executor = None
+        self.owner_pid = None
+
+    def setup(self, schema=None):
+        if self.workers == 0 or self.owner_pid == os.getpid():
+            return
+        # Loaded once here and inherited by every pool process
+        preload_eccodes(schema)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context('fork'))
+        self.owner_pid = os.getpid()
+
+    def close(self):
+        if self.owner_pid != os.getpid():
+            return
+        self.executor.shutdown(wait=True)
+        self.owner_pid = None
+
+    def decode_many(self, payloads, schema):
+        # Decode in-memory payloads; returns (columns, error) pairs in the same order
+        return self.run(decode_columns, payloads, schema)
+
+    def decode_files(self, file_paths, schema):
+        # Decode files on disk; each worker reads its own files
+        return self.run(decode_file_columns, file_paths, schema)
+
+    def run(self, function, items, schema):
+        if self.workers == 0:
+            results = []
+            for item in items:
+                try:
+                    results.append((function(item, schema), None))
+                except Exception as e:
+                    logging.debug(traceback.format_exc())
+                    results.append((None, e))
+            return results
+
+        self.setup(schema)
+        futures = [self.executor.submit(function, item, schema) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
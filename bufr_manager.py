@@ -1,84 +1,138 @@
 # bufr_manager.py
 import os
 import logging
-import traceback
-import requests
-from eccodes import *
 
 from config_reader import ConfigReader
 from database_manager import DatabaseManager
+from downloader import Downloader
+from archive_writer import ArchiveWriter
+from bufr_decoder import DecodeEngine
+from decoded_batch import BufrSchema
+from parquet_sink import ParquetSink
+from metrics import counter, histogram
 
 CONFIG_DIR = 'config'
 GENERAL_CONFIG_FILE = 'general_config.ini'
 BUFR_KEYS_FILE = 'BUFRKeys.ini'
 
+DECODE_SECONDS = histogram('wis2_decode_seconds', "Time to decode one file")
+DECODE_MESSAGE_SECONDS = histogram('wis2_decode_message_seconds', "Decode time per BUFR message",
+                                   buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5))
+DECODED_MESSAGES = counter('wis2_decoded_messages_total', "BUFR messages decoded")
+DROPPED = counter('wis2_messages_dropped_total', "Notifications dropped, by reason", ('reason',))
+
 class BufrFileManager:
-    def __init__(self):
+    def __init__(self, db_manager=None):
         # Initialize BufrFileManager with configuration and database manager
         general_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'General')
         self.download_directory = general_config['DownloadDirectory']
-        self.db_manager = DatabaseManager()
-
-    def download_file(self, data_list, constructed_link, message_id):
-        # Download a file from a given URL, save it locally, and decode
-        data_entry = data_list[-1]
-        download_url = data_entry['canonical_url']
-        file_name = os.path.basename(download_url)
-        local_path = os.path.join(os.path.join(self.download_directory, constructed_link), file_name)
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        
-        try:
-            logging.debug(f"Attempting to download from URL: {download_url}")
-            response = requests.get(download_url)
-            response.raise_for_status()
-
-            with open(local_path, 'wb') as file:
-                file.write(response.content)
-
-            logging.info(f"File downloaded successfully: {local_path}")
-
-            # Decode the downloaded file
-            decoded_data = self.decode_bufr_file(local_path)
-
-            # Insert decoded BUFR data into the database
-            self.db_manager.insert_bufr_data(message_id, decoded_data)
-
-            print(decoded_data)
-
-        except requests.RequestException as e:
-            logging.error(f"Error during file download: {e}")
-            logging.debug(traceback.format_exc())
-        except Exception as e:
-            logging.error(f"Error during file decoding: {e}")
-            logging.debug(traceback.format_exc())
-
-    def decode_bufr_file(self, file_path):
-        # Decode a BUFR file and return the decoded data
-        keys_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE), 'BUFRKeys')
-        required_columns = keys_config.get('required_columns', '').split(',')
-        additional_columns = keys_config.get('additional_columns', '').split(',')
-        keys = required_columns + additional_columns
-        
-        decoded_data = {'message_count': 0, 'messages': []}
-
-        with open(file_path, 'rb') as bufr_file:
-            while True:
-                bufr = codes_bufr_new_from_file(bufr_file)
-                if bufr is None:
-                    break
-
-                codes_set(bufr, "unpack", 1)
-
-                message_data = {'message_number': decoded_data['message_count']}
-
-                for key in keys:
-                    message_data[key] = codes_get(bufr, key)
-                    if message_data[key] in (CODES_MISSING_DOUBLE, CODES_MISSING_LONG):
-                        message_data[key] = None
-
-                decoded_data['messages'].append(message_data)
-                decoded_data['message_count'] += 1
-
-                codes_release(bufr)
-
-        return decoded_data
+        self.db_manager = db_manager if db_manager is not None else DatabaseManager()
+        downloader_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Downloader')
+        self.downloader = Downloader.from_config(downloader_config)
+
+        # Decode the downloaded bytes in memory, archiving them on a background thread,
+        # or fall back to writing the file first and decoding it from disk
+        self.decode_from_memory = general_config.get('DecodeFromMemory', 'true').lower() == 'true'
+        self.archive_downloads = general_config.get('ArchiveDownloads', 'true').lower() == 'true'
+        self.archive_writer = ArchiveWriter()
+
+        # Decoding is CPU-bound, so it can be spread over a pool of processes
+        self.decode_engine = DecodeEngine(general_config.get('DecodeWorkers', 0))
+
+        # Optional columnar copy of the decoded observations (requires pyarrow)
+        self.parquet_sink = ParquetSink.from_config(ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Parquet'))
+
+    def local_path(self, message):
+        # Archive path of a message: DownloadDirectory/<topic>/<YYYYMMDD>/<file name>
+        file_name = os.path.basename(message.canonical_url)
+        return os.path.join(self.download_directory, message.archive_directory, file_name)
+
+    def fetch_and_decode_many(self, messages):
+        # Download the files of several Messages concurrently, then decode them;
+        # returns the decoded data (or None) in the same order
+        if self.decode_from_memory:
+            return self.fetch_and_decode_in_memory(messages)
+
+        jobs = []
+        for message in messages:
+            download_url = message.canonical_url
+            logging.debug("Attempting to download from URL: %s", download_url)
+            local_path = self.local_path(message)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            jobs.append((download_url, local_path))
+
+        schema = BufrSchema.load(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE))
+        downloaded = []
+        positions = []
+        for position, ((download_url, local_path), (downloaded_path, error)) in enumerate(zip(jobs, self.downloader.download_many(jobs))):
+            if error is not None:
+                logging.error("Error during file download from %s: %s", download_url, error)
+                DROPPED.labels('download_error').inc()
+                continue
+            logging.info("File downloaded successfully: %s", downloaded_path)
+            downloaded.append(downloaded_path)
+            positions.append(position)
+
+        # Decode the downloaded files
+        results = [None] * len(messages)
+        for position, decoded_data in zip(positions, self.log_decode_errors(self.decode_engine.decode_files(downloaded, schema))):
+            results[position] = decoded_data
+        return results
+
+    def fetch_and_decode_in_memory(self, messages):
+        # Download the files into memory and decode the bytes directly;
+        # archiving to DownloadDirectory happens asynchronously when enabled
+        urls = [message.canonical_url for message in messages]
+        schema = BufrSchema.load(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE))
+
+        payloads = []
+        positions = []
+        for position, (message, download_url, (payload, error)) in enumerate(zip(messages, urls, self.downloader.fetch_many(urls))):
+            if error is not None:
+                logging.error("Error during file download from %s: %s", download_url, error)
+                DROPPED.labels('download_error').inc()
+                continue
+
+            logging.debug("File downloaded successfully: %s", download_url)
+            if self.archive_downloads:
+                self.archive_writer.write(self.local_path(message), payload)
+            payloads.append(payload)
+            positions.append(position)
+
+        results = [None] * len(messages)
+        for position, decoded_data in zip(positions, self.log_decode_errors(self.decode_engine.decode_many(payloads, schema))):
+            results[position] = decoded_data
+        return results
+
+    def export(self, message, message_id, decoded_data):
+        # Add decoded data to the Parquet export when it is enabled
+        if self.parquet_sink is not None:
+            self.parquet_sink.add(message, message_id, decoded_data)
+
+    def flush_due(self):
+        # Time-based flushes of the Parquet export, called while the worker waits for batches
+        if self.parquet_sink is not None:
+            self.parquet_sink.flush_due()
+
+    def log_decode_errors(self, decoded):
+        # Turn (decoded_data, error) pairs into decoded data, logging failures as None
+        results = []
+        for decoded_data, error in decoded:
+            if error is not None:
+                logging.error(f"Error during file decoding: {error}")
+                DROPPED.labels('decode_error').inc()
+            else:
+                DECODE_SECONDS.observe(decoded_data.decode_seconds)
+                DECODED_MESSAGES.inc(decoded_data.message_count)
+                if decoded_data.message_count:
+                    DECODE_MESSAGE_SECONDS.observe(decoded_data.decode_seconds / decoded_data.message_count)
+            results.append(decoded_data)
+        return results
+
+    def close(self):
+        # Flush pending archive writes and Parquet rows, release the download connections and decode workers
+        self.archive_writer.close()
+        self.downloader.close()
+        self.decode_engine.close()
+        if self.parquet_sink is not None:
+            self.parquet_sink.close()
@@ -1,14 +1,103 @@
 # config_reader.py
 import configparser
+import os
+import re
+import signal
+import threading
+import time
+from collections import namedtuple
+
+# How often (in seconds) a cached file's mtime is checked for changes
+CHECK_INTERVAL = 5
+
+BufrKeys = namedtuple('BufrKeys', ['required_columns', 'additional_columns', 'keys', 'integer_keys', 'string_keys'])
+
+class CachedConfig:
+    def __init__(self, parser, mtime):
+        # A parsed file with its mtime and the structures derived from it
+        self.parser = parser
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+        self.derived = {}
 
 class ConfigReader:
+    # Parsed files are cached per process and reloaded only when their mtime changes
+    cache = {}
+    lock = threading.RLock()
+
     @staticmethod
     def read_config(file_path, section):
         try:
-            config = configparser.ConfigParser()
-            config.read(file_path)
-            return config[section]
-        except (configparser.Error, FileNotFoundError) as e:
+            return ConfigReader.load(file_path).parser[section]
+        except (configparser.Error, FileNotFoundError, KeyError) as e:
             # Log the error or handle it according to your needs
             print(f"Error reading config file '{file_path}': {e}")
             return {}
+
+    @staticmethod
+    def load(file_path):
+        # Return the cached parse of file_path, re-reading it if its mtime changed
+        with ConfigReader.lock:
+            cached = ConfigReader.cache.get(file_path)
+            now = time.monotonic()
+            if cached is not None and now - cached.checked_at < CHECK_INTERVAL:
+                return cached
+
+            try:
+                mtime = os.stat(file_path).st_mtime
+            except OSError:
+                mtime = None
+
+            if cached is not None and cached.mtime == mtime:
+                cached.checked_at = now
+                return cached
+
+            config = configparser.ConfigParser()
+            config.read(file_path)
+            cached = CachedConfig(config, mtime)
+            ConfigReader.cache[file_path] = cached
+            return cached
+
+    @staticmethod
+    def derived(file_path, name, builder):
+        # Cache a structure computed from a parsed file until the file is reloaded
+        cached = ConfigReader.load(file_path)
+        with ConfigReader.lock:
+            if name not in cached.derived:
+                cached.derived[name] = builder(cached.parser)
+            return cached.derived[name]
+
+    @staticmethod
+    def bufr_keys(file_path):
+        # Stripped BUFR key lists from the [BUFRKeys] section, and the integer and string keys
+        # of the [BUFRKeyTypes] section
+        def build(config):
+            def key_list(section, option):
+                section = config[section] if config.has_section(section) else {}
+                return [key.strip() for key in section.get(option, '').split(',') if key.strip()]
+            required_columns = key_list('BUFRKeys', 'required_columns')
+            additional_columns = key_list('BUFRKeys', 'additional_columns')
+            return BufrKeys(required_columns, additional_columns, required_columns + additional_columns,
+                            key_list('BUFRKeyTypes', 'integer_keys'), key_list('BUFRKeyTypes', 'string_keys'))
+        return ConfigReader.derived(file_path, 'bufr_keys', build)
+
+    @staticmethod
+    def blacklist_matcher(file_path):
+        # Compiled pattern matching any blacklisted key of the [Blacklist] section
+        def build(config):
+            keys = config.options('Blacklist') if config.has_section('Blacklist') else []
+            if not keys:
+                return re.compile(r'(?!)')
+            return re.compile('|'.join(re.escape(key) for key in keys))
+        return ConfigReader.derived(file_path, 'blacklist', build)
+
+    @staticmethod
+    def invalidate():
+        # Forget every cached file so the next access re-reads it
+        with ConfigReader.lock:
+            ConfigReader.cache.clear()
+
+    @staticmethod
+    def install_reload_handler():
+        # Reload the configuration on SIGHUP
+        signal.signal(signal.SIGHUP, lambda signum, frame: ConfigReader.invalidate())
@@ -3,116 +3,429 @@ import logging
 from queue import Empty
 import multiprocessing
 import os
-import re
+import signal
 import time
+import traceback
 
-from datetime import datetime
+from datetime import datetime, timezone
+import metrics
 from config_reader import ConfigReader
-from mqtt_subscriber import MqttSubscriber
+from notification import parse_message, topic_centre
 from database_manager import DatabaseManager
 from bufr_manager import BufrFileManager
+from bufr_decoder import preload_eccodes
+from decoded_batch import BufrSchema
+from worker_pool import BatchWorkerPool
+from dedup_cache import DedupCache
+from spool import Spool, SpooledBatch
+from aggregator import AvailabilityAggregator
+from flush_scheduler import FlushScheduler
 
 CONFIG_DIR = 'config'
 DATABASE_CONFIG_FILE = 'database_config.ini'  # Utilisation du nom correct du fichier de configuration
 GENERAL_CONFIG_FILE = 'general_config.ini'
+BUFR_KEYS_FILE = 'BUFRKeys.ini'
+
+QUEUE_DEPTH = metrics.gauge('wis2_queue_depth', "Notifications waiting for the DataProcessor (queue or spool)")
+PENDING_BATCHES = metrics.gauge('wis2_pending_batches', "Batches waiting for a free worker")
+BATCHES = metrics.counter('wis2_batches_total', "Batches handed to the workers, by flush reason", ('reason',))
+BATCH_SIZE = metrics.histogram('wis2_batch_size', "Notifications per batch", buckets=metrics.SIZE_BUCKETS)
+DROPPED = metrics.counter('wis2_messages_dropped_total', "Notifications dropped, by reason", ('reason',))
+MESSAGES_STORED = metrics.counter('wis2_messages_stored_total', "Messages inserted into the database, by centre", ('centre_id',))
+PUBLICATION_LAG = metrics.histogram('wis2_publication_lag_seconds', "Delay between publication and insertion, by centre",
+                                    ('centre_id',), buckets=metrics.LAG_BUCKETS)
 
 class DataProcessor:
     def __init__(self, queue):
-        # Initialize DataProcessor with a message queue and necessary managers
+        # Initialize DataProcessor with a message queue and a pool of batch workers
         self.queue = queue
+        processor_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Processor')
+        # Batch size and flush deadlines, adapted to the backlog and the worker latency
+        self.scheduler = FlushScheduler.from_config(processor_config)
+        self.STATS_INTERVAL = float(processor_config.get('StatsInterval', 60))
+
+        # Notifications delivered more than once (several brokers/caches) are dropped here,
+        # before they reach a worker; the unique index on message catches the rest
+        dedup_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Dedup')
+        self.dedup_cache = DedupCache(dedup_config.get('Size', 100000), dedup_config.get('TTL', 86400))
+
+        # The managers are created once per worker process by init_worker
+        self.db_manager = None
+        self.bufr_manager = None
+        self.last_stats_time = time.time()
+        self.worker_pool = BatchWorkerPool(self.handle_batch, initializer=self.init_worker,
+                                           finalizer=self.close_worker,
+                                           workers=processor_config.get('Workers', 4),
+                                           max_pending=processor_config.get('MaxPendingBatches', 8),
+                                           idle=self.worker_idle,
+                                           idle_interval=processor_config.get('IdleInterval', 30))
+        self.is_running = False
+
+        # Optional on-disk spool between the subscriber and the processor; when enabled the
+        # subscriber writes to it instead of the queue and the workers ack stored batches
+        self.spool = Spool.from_config(ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Spool'))
+        self.spool_ids = []
+        self.spool_replayed = False
+
+        # Availability and latency per centre/station/hour, counted as notifications are dispatched
+        self.aggregator = AvailabilityAggregator.from_config(
+            ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Aggregator'), DatabaseManager())
+
+        # Daily partitions are created ahead of time and dropped after the retention period
+        retention_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Retention')
+        self.partition_maintenance = str(retention_config.get('Enabled', 'true')).lower() == 'true'
+        self.retention_days = int(retention_config.get('Days', 90))
+        self.partitions_ahead = int(retention_config.get('PartitionsAhead', 7))
+        self.maintenance_interval = float(retention_config.get('CheckInterval', 3600))
+
+        # Metrics are served by this process; the workers and the subscriber push theirs here
+        metrics_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Metrics')
+        self.metrics_enabled = str(metrics_config.get('Enabled', 'true')).lower() == 'true'
+        self.metrics_port = int(metrics_config.get('Port', 9108))
+        self.metrics_host = metrics_config.get('Host', '127.0.0.1')
+        self.metrics_push_interval = float(metrics_config.get('PushInterval', 5))
+        self.metrics_server = None
+        if self.metrics_enabled:
+            metrics.enable_collection()
+        self.duplicates = DROPPED.labels('duplicate')
+
+    def init_worker(self):
+        # Build the database and BUFR managers once for the lifetime of a worker
+        ConfigReader.install_reload_handler()
+        metrics.start_pusher(self.metrics_push_interval)
         self.db_manager = DatabaseManager()
-        self.bufr_manager = BufrFileManager()
-        self.BATCH_SIZE = 50
+        self.bufr_manager = BufrFileManager(self.db_manager)
+        self.last_stats_time = time.time()
+
+    def close_worker(self):
+        # Flush pending archive writes and release connections before a worker exits
+        self.bufr_manager.close()
+        self.db_manager.close()
+        if self.spool is not None:
+            self.spool.close()
+        metrics.push_now()
+
+    def worker_idle(self):
+        # Called in every worker at least every IdleInterval seconds, even without batches
+        self.bufr_manager.flush_due()
+
+    def handle_batch(self, batch):
+        # Worker entry point: process a batch, then ack its spool entries
+        # (a failed batch is not acked and is delivered again when its lease expires)
+        self.renew_lease(batch)
+        self.process_batch(batch)
+        spool_ids = getattr(batch, 'spool_ids', None)
+        if spool_ids:
+            self.spool.ack(spool_ids)
+
+    def renew_lease(self, batch):
+        # Restart the spool lease of a batch: it must not expire, and the batch be leased again,
+        # while the batch waits for a worker or downloads its files
+        spool_ids = getattr(batch, 'spool_ids', None)
+        if spool_ids:
+            self.spool.renew(spool_ids)
 
     def process_batch(self, bufr_copy):
-        for message in bufr_copy:
-            self.process_message(message)
+        # Filter the batch, insert all message rows in one statement,
+        # then download and decode each file and insert all BUFR rows together
+        prepared = []
+        for payload in bufr_copy:
+            try:
+                message = self.prepare_message(payload)
+            except Exception as e:
+                logging.error("Error preparing message: %s", e)
+                continue
+            if message is not None:
+                prepared.append(message)
+
+        if not prepared:
+            return
+
+        message_ids = self.db_manager.insert_messages(prepared)
+
+        # Messages already in the table come back without an id and are not downloaded again
+        self.record_stored(prepared, message_ids)
+        recovered = False
+        if getattr(bufr_copy, 'replayed', False):
+            message_ids, recovered = self.recover_replayed(prepared, message_ids)
+        stored = [(message, message_id) for message, message_id in zip(prepared, message_ids) if message_id is not None]
+        if not stored:
+            return
+
+        # Download the files of the batch concurrently and decode them
+        decoded_batch = []
+        exported = []
+        messages = [message for message, _ in stored]
+        for (message, message_id), decoded_data in zip(stored, self.bufr_manager.fetch_and_decode_many(messages)):
+            if decoded_data is not None:
+                decoded_batch.append((message_id, message.publication_timestamp, decoded_data))
+                exported.append((message, message_id, decoded_data))
+
+        # The downloads may have taken most of the lease
+        self.renew_lease(bufr_copy)
+
+        # The rows of recovered messages replace any that another delivery loaded meanwhile
+        self.db_manager.insert_bufr_batch(decoded_batch, replace=recovered)
+
+        # The optional Parquet export comes last: its failures never cost the database rows
+        try:
+            for message, message_id, decoded_data in exported:
+                self.bufr_manager.export(message, message_id, decoded_data)
+        except Exception as e:
+            logging.error("Error exporting batch to Parquet: %s", e)
+            logging.debug(traceback.format_exc())
+
+        if time.time() - self.last_stats_time >= self.STATS_INTERVAL:
+            self.bufr_manager.downloader.log_stats()
+            self.last_stats_time = time.time()
+
+    def recover_replayed(self, prepared, message_ids):
+        # A replayed batch failed after its messages were stored but before their BUFR rows were:
+        # give back the ids of the messages stored without BUFR rows so their files are loaded again
+        # Returns the message ids and whether any was recovered
+        inserted = {(message.data_id, message.publication_timestamp)
+                    for message, message_id in zip(prepared, message_ids) if message_id is not None}
+        conflicting = [message for message, message_id in zip(prepared, message_ids)
+                       if message_id is None and (message.data_id, message.publication_timestamp) not in inserted]
+        missing = self.db_manager.find_messages_without_bufr(conflicting)
+        if not missing:
+            return message_ids, False
+        logging.info("Loading the BUFR rows of %d replayed messages", len(missing))
+        return [missing.pop((message.data_id, message.publication_timestamp), None) if message_id is None else message_id
+                for message, message_id in zip(prepared, message_ids)], True
+
+    def record_stored(self, prepared, message_ids):
+        # Count the inserted messages and their publication lag per centre
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        for message, message_id in zip(prepared, message_ids):
+            if message_id is None:
+                DROPPED.labels('duplicate_db').inc()
+                continue
+            centre_id = topic_centre(message.topic)
+            MESSAGES_STORED.labels(centre_id).inc()
+            PUBLICATION_LAG.labels(centre_id).observe(max(0.0, (now - message.publication_timestamp).total_seconds()))
 
     def process_messages(self):
         # Continuously process messages from the queue
-        # process_batch is called every 5 seconds or when the batch size is reached
+        # A batch is handed to the worker pool when the scheduler's batch size is reached
+        # or when its oldest notification has waited MaxStaleness seconds
+
+        self.preload_decoder()
+        self.worker_pool.start()
+        if self.metrics_enabled:
+            if self.spool is None:
+                QUEUE_DEPTH.set_function(self.queue.qsize)
+            # With a spool the in-process queue stays empty: backlog() sets the spool depth from this
+            # thread (the spool connection is not shared with the metrics server thread)
+            PENDING_BATCHES.set_function(self.worker_pool.batch_queue.qsize)
+            self.metrics_server = metrics.MetricsServer(self.metrics_port, self.metrics_host)
+            self.metrics_server.start()
+        self.is_running = True
+        if self.spool is not None:
+            # Anything leased by a previous run was never acked: deliver it again
+            self.spool.release_all()
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGHUP, self.handle_reload)
 
         buffer = []  # Initialize an empty buffer
-        last_batch_time = time.time()  # Record the time when the last batch was processed
+        last_stats_time = time.time()
+        self.maintain_partitions()
+        last_maintenance_time = last_stats_time
 
-        while True:
+        try:
+            while self.is_running:
+                idle = False
+                try:
+                    # Wait no longer than the buffer may still wait
+                    payload = self.next_notification(self.scheduler.timeout())
+                    if payload is not None:
+                        buffer.append(payload) # Add the payload to the buffer
+                        self.scheduler.added()
+                except Empty:
+                    idle = True
+
+                # Checked on every pass, so a quiet queue cannot strand a partial buffer
+                reason = self.scheduler.due(len(buffer))
+                if reason is not None:
+                    # Submit the batch, blocking while all workers are busy
+                    self.submit_batch(buffer, reason)
+                    buffer = []
+                    self.scheduler.flushed()
+                elif not buffer and self.spool_ids and (idle or len(self.spool_ids) >= self.scheduler.batch_size):
+                    # Only duplicates came out of the spool: ack them without a batch
+                    self.submit_batch(buffer, 'duplicates')
+
+                self.scheduler.maybe_adapt(self.backlog, self.worker_pool.stats)
+
+                if time.time() - last_stats_time >= self.STATS_INTERVAL:
+                    self.worker_pool.log_stats()
+                    logging.info("Dedup cache: %d duplicates dropped, %d entries",
+                                 self.dedup_cache.hits, len(self.dedup_cache))
+                    last_stats_time = time.time()
+
+                if self.aggregator is not None:
+                    self.aggregator.maybe_flush()
+
+                if time.time() - last_maintenance_time >= self.maintenance_interval:
+                    self.maintain_partitions()
+                    last_maintenance_time = time.time()
+
+        except KeyboardInterrupt:
+            logging.info("Interrupted, shutting down the data processor")
+        finally:
+            self.shutdown(buffer)
+
+    def preload_decoder(self):
+        # Load eccodes, its BUFR tables and the configured keys once here; the workers inherit them through fork
+        general_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'General')
+        table_versions = [version.strip() for version in general_config.get('PreloadTableVersions', '38,39,40,41').split(',')
+                          if version.strip()]
+        preload_eccodes(BufrSchema.load(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE)), table_versions)
+
+    def maintain_partitions(self):
+        # Create the coming daily partitions and drop the expired ones from the dispatcher process
+        if not self.partition_maintenance:
+            return
+        db_manager = DatabaseManager()
+        try:
+            db_manager.maintain_partitions(self.partitions_ahead, self.retention_days)
+        finally:
+            db_manager.close()
+
+    def next_notification(self, timeout=1):
+        # Next notification to batch from the queue or the spool, None for a duplicate
+        # Raises Empty when nothing arrived within the timeout
+        if self.spool is None:
+            payload = self.queue.get(timeout=timeout)
+            return payload if self.is_new(payload) else None
+
+        spool_id, payload, replayed = self.spool.get(timeout=timeout, batch_size=self.scheduler.batch_size)
+        # Duplicates are acked along with the next batch; replays already passed the dedup cache
+        self.spool_ids.append(spool_id)
+        self.spool_replayed = self.spool_replayed or replayed
+        return payload if replayed or self.is_new(payload) else None
+
+    def backlog(self):
+        # Notifications waiting for the dispatcher or for a worker
+        if self.spool is not None:
+            waiting = self.spool.report()
+            QUEUE_DEPTH.set(waiting)
+        else:
+            waiting = self.queue.qsize()
+        return waiting + self.worker_pool.batch_queue.qsize() * self.scheduler.batch_size
+
+    def is_new(self, payload):
+        # False for a notification already seen recently
+        try:
+            key = DedupCache.notification_key(payload)
+        except (TypeError, ValueError):
+            # Malformed payloads are left to the workers to reject
+            return True
+        duplicate = self.dedup_cache.seen(key)
+        if self.aggregator is not None:
             try:
-                payload = self.queue.get(timeout=1)
-                buffer.append(payload) # Add the payload to the buffer
-                # Check if BATCH_SIZE is reached
-                if len(buffer) >= self.BATCH_SIZE:
-                    # Process the batch if BATCH_SIZE is reached
-                    multiprocessing.Process(target=self.process_batch, args=(buffer.copy(),)).start()
-                    buffer = []  # Clear the original buffer
-                    last_batch_time = time.time()  # Update last_batch_time
-                    continue
-                # Check if 5 seconds have elapsed since the last batch processing
-                current_time = time.time()
-                if current_time - last_batch_time >= 5:
-                    # Process the current buffer and reset last_batch_time
-                    multiprocessing.Process(target=self.process_batch, args=(buffer.copy(),)).start()
-                    buffer = []  # Clear the original buffer
-                    last_batch_time = current_time  # Update last_batch_time
-                
+                self.aggregator.observe(payload, duplicate)
+            except (TypeError, ValueError) as e:
+                logging.debug("Notification not aggregated: %s", e)
+        if duplicate:
+            self.duplicates.inc()
+            return False
+        return True
+
+    def handle_signal(self, signum, frame):
+        # Stop the dispatch loop; the buffer is drained in shutdown()
+        self.is_running = False
+
+    def handle_reload(self, signum, frame):
+        # Reload the configuration here and in every batch worker
+        ConfigReader.invalidate()
+        self.worker_pool.signal_workers(signal.SIGHUP)
+
+    def shutdown(self, buffer):
+        # Drain the pending buffer and whatever is left on the queue, then stop the workers
+        self.is_running = False
+        # Spooled notifications not leased yet simply stay on disk for the next run
+        while self.spool is None:
+            try:
+                payload = self.queue.get_nowait()
             except Empty:
-                pass
-
-    def process_message(self, payload):
-        # Process individual message payload
-        data_list = []
-
-        # Extract information from the payload
-        topic_pattern = re.compile(r'wis2/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/synop')
-        match = topic_pattern.search(payload['topic'])
-        topic = match.group(0) if match else 'N/A'
-
-        publication_timestamp = payload['data']['properties'].get('pubtime', 'N/A')
-        data_id = payload['data']['properties'].get('data_id', 'N/A')
-        canonical_url = next((link['href'] for link in payload['data'].get('links', []) if link.get('rel') == 'canonical'), 'N/A')
-        wigos_station_identifier = payload['data']['properties'].get('wigos_station_identifier', 'N/A')
-
-        # Add variables to data_list
-        data_list.append({
-            'topic': topic,
-            'publication_timestamp': publication_timestamp,
-            'data_id': data_id,
-            'canonical_url': canonical_url,
-            'wigos_station_identifier': wigos_station_identifier
-        })
-
-        # Check blacklist and file format restrictions
-        blacklist = ConfigReader.read_config(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE), 'Blacklist')
-        blacklist = [[key, value] for key, value in blacklist.items()]
-
-        if all(key not in data_id for key, value in blacklist):
-            not_allowed_extensions = ['.png', '.jpeg', '.jpg']
-            if not any(canonical_url.lower().endswith(ext) for ext in not_allowed_extensions):
-                # Insert message data into the database
-                message_id = self.db_manager.insert_message_data(data_list)
-                publication_timestamp_obj = datetime.strptime(publication_timestamp, "%Y-%m-%dT%H:%M:%SZ") if '.' not in publication_timestamp else datetime.strptime(publication_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-                date_directory = publication_timestamp_obj.strftime("%Y%m%d")
-                constructed_link = f"{topic}/{date_directory}"
-
-                # Download the file locally
-                self.bufr_manager.download_file(data_list, constructed_link, message_id)
+                break
+            if self.is_new(payload):
+                buffer.append(payload)
+            if len(buffer) >= self.scheduler.batch_size:
+                self.submit_batch(buffer, 'shutdown')
+                buffer = []
+        self.submit_batch(buffer, 'shutdown')
+        self.worker_pool.stop()
+        self.worker_pool.log_stats()
+        if self.aggregator is not None:
+            self.aggregator.flush()
+            self.aggregator.db_manager.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+    def submit_batch(self, buffer, reason):
+        # Hand a batch to the workers, recording its size and what triggered the flush
+        # (an empty buffer only acks the spooled duplicates)
+        if buffer:
+            BATCHES.labels(reason).inc()
+            BATCH_SIZE.observe(len(buffer))
+        if self.spool is not None:
+            if buffer:
+                buffer = SpooledBatch(buffer, self.spool_ids, self.spool_replayed)
+            else:
+                # Only duplicates since the last batch: nothing to process
+                self.spool.ack(self.spool_ids)
+            self.spool_ids = []
+            self.spool_replayed = False
+        if buffer:
+            self.worker_pool.submit(buffer)
+            # submit() may have blocked while every worker was busy
+            self.renew_lease(buffer)
+
+    def prepare_message(self, payload):
+        # Build the Message of a queued notification (notification.py)
+        # Returns None when the message is blacklisted or not a supported file format
+        blacklist = ConfigReader.blacklist_matcher(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE))
+        if blacklist.search(payload[3]):
+            return None
+        return parse_message(payload)
 
 def main():
+    # paho is only needed by the subscriber processes forked from here
+    from mqtt_subscriber import MqttSubscriber
+
     # Create a multiprocessing queue for communication between processes
     message_queue = multiprocessing.Queue()
 
-    # Start the MQTT Subscriber in a separate process
+    # Create the Data Processor first, so the subscriber process can report its metrics to it
+    data_processor = DataProcessor(message_queue)
+
+    # Start the MQTT Subscribers in separate processes
     general_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, 'general_config.ini'), 'General')
     gs = general_config['GS']
     mqtt_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, 'mqtt_config.ini'), gs)
-    mqtt_subscriber_process = multiprocessing.Process(target=MqttSubscriber(gs, mqtt_config, message_queue).start)
-    mqtt_subscriber_process.start()
-
-    # Start the Data Processor in the main process
-    data_processor = DataProcessor(message_queue)
-    data_processor.process_messages()
+    # With the spool enabled the subscribers append to it instead of the in-memory queue
+    subscriber_queue = data_processor.spool if data_processor.spool is not None else message_queue
+    # Several subscribers only make sense with a shared subscription, each one then gets
+    # its share of the stream and they all feed this instance's processor pool
+    subscriber_count = int(mqtt_config.get('Subscribers', 1)) if mqtt_config.get('SharedGroup') else 1
+    mqtt_subscriber_processes = []
+    for index in range(subscriber_count):
+        subscriber = MqttSubscriber(gs, mqtt_config, subscriber_queue, index)
+        process = multiprocessing.Process(target=subscriber.start, name=f"mqtt-subscriber-{index}")
+        process.start()
+        mqtt_subscriber_processes.append(process)
 
-    # Wait for the MQTT Subscriber to finish before terminating the main process
-    mqtt_subscriber_process.join()
+    # Run the Data Processor in the main process
+    try:
+        data_processor.process_messages()
+    finally:
+        # Stop the MQTT Subscribers before terminating the main process
+        for process in mqtt_subscriber_processes:
+            process.terminate()
+        for process in mqtt_subscriber_processes:
+            process.join()
 
 if __name__ == "__main__":
     main()
@@ -1,20 +1,69 @@
 # database_manager.py
 import logging
 import os
-import json
+import time
 import psycopg2
+from contextlib import contextmanager
+from itertools import repeat
+from operator import attrgetter
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 from datetime import datetime
 from config_reader import ConfigReader
+from decoded_batch import BufrSchema
+from metrics import counter, histogram, SIZE_BUCKETS
 
 CONFIG_DIR = 'config'
 DATABASE_CONFIG_FILE = 'database_config.ini'
 BUFR_KEYS_FILE = 'BUFRKeys.ini'
 
+MESSAGE_COLUMNS = ['topic', 'publication_timestamp', 'data_id', 'canonical_url', 'wigos_station_identifier']
+# Values of a Message in MESSAGE_COLUMNS order
+MESSAGE_ROW = attrgetter(*MESSAGE_COLUMNS)
+BUFR_PAGE_SIZE = 1000
+
+# notification.topic_centre in SQL: the levels between "wis2" and "data" of a stored topic
+# (e.g. fra/meteofrance), so the rollups join with the metrics and the availability tables
+TOPIC_CENTRE_SQL = ("CASE WHEN split_part(topic, '/', 1) = 'wis2' THEN "
+                    "coalesce(substring(topic FROM '^wis2/(.+?)/data(?:/|$)'), split_part(topic, '/', 2)) ELSE '' END")
+
+# Upserts of the hourly rollup tables from the rows returned by the "inserted" CTE of insert_messages
+HOURLY_CENTRE_ROLLUP = f"""
+                INSERT INTO message_hourly_centre (hour, centre_id, messages, latency_sum, latency_max)
+                SELECT date_trunc('hour', publication_timestamp), {TOPIC_CENTRE_SQL}, count(*),
+                       coalesce(sum(latency), 0), max(latency)
+                FROM inserted
+                GROUP BY 1, 2
+                ON CONFLICT (hour, centre_id) DO UPDATE SET
+                    messages = message_hourly_centre.messages + EXCLUDED.messages,
+                    latency_sum = message_hourly_centre.latency_sum + EXCLUDED.latency_sum,
+                    latency_max = GREATEST(message_hourly_centre.latency_max, EXCLUDED.latency_max)"""
+HOURLY_STATION_ROLLUP = f"""
+                INSERT INTO message_hourly_station (hour, wigos_station_identifier, centre_id, messages, latency_sum, latency_max)
+                SELECT date_trunc('hour', publication_timestamp), wigos_station_identifier, min({TOPIC_CENTRE_SQL}),
+                       count(*), coalesce(sum(latency), 0), max(latency)
+                FROM inserted
+                WHERE wigos_station_identifier IS NOT NULL
+                GROUP BY 1, 2
+                ON CONFLICT (hour, wigos_station_identifier) DO UPDATE SET
+                    messages = message_hourly_station.messages + EXCLUDED.messages,
+                    latency_sum = message_hourly_station.latency_sum + EXCLUDED.latency_sum,
+                    latency_max = GREATEST(message_hourly_station.latency_max, EXCLUDED.latency_max)"""
+
+# Deletes the BUFR rows of a list of (message_id, publication_timestamp) before they are inserted again
+DELETE_BUFR_QUERY = """
+    DELETE FROM bufr USING (VALUES %s) AS replaced (message_id, publication_timestamp)
+    WHERE bufr.message_id = replaced.message_id AND bufr.publication_timestamp = replaced.publication_timestamp;
+"""
+
+DROPPED = counter('wis2_messages_dropped_total', "Notifications dropped, by reason", ('reason',))
+INSERT_SECONDS = histogram('wis2_db_insert_seconds', "Time to write one batch, by table", ('table',))
+ROWS_PER_STATEMENT = histogram('wis2_db_rows_per_statement', "Rows sent per INSERT statement, by table",
+                               ('table',), SIZE_BUCKETS)
+
 class DatabaseManager:
     def __init__(self):
-        # Initialize the database connection pool
-        # Initialize the database connection pool
+        # Read the connection settings; the pool itself is created lazily in each process
         database_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, DATABASE_CONFIG_FILE), 'Database')
         self.db_config = {
             'dbname': database_config['dbname'],
@@ -23,73 +72,281 @@ class DatabaseManager:
             'host': database_config['host'],
             'port': database_config['port']
         }
+        self.min_connections = int(database_config.get('PoolMinConnections', 1))
+        self.max_connections = int(database_config.get('PoolMaxConnections', 4))
+        # The raw_data JSONB copy of every key can be left out when the Parquet export keeps them
+        self.store_raw_data = str(database_config.get('StoreRawData', 'true')).lower() == 'true'
+        self.pool = None
+        self.pool_pid = None
 
-    def insert_message_data(self, data_list):
-        db_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, DATABASE_CONFIG_FILE), 'Database')
-        # Insert message data into the 'message' table
-        query = """
-            INSERT INTO message (topic, publication_timestamp, data_id, canonical_url, wigos_station_identifier)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id;
+    def get_pool(self):
+        # One pool per process: a pool inherited through fork belongs to the parent,
+        # so it is dropped (not closed, which would end the parent's sessions) and rebuilt
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = pool.ThreadedConnectionPool(self.min_connections, self.max_connections, **self.db_config)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    @contextmanager
+    def connection(self):
+        # Borrow a pooled connection, committing on success and rolling back on error
+        connection_pool = self.get_pool()
+        connection = connection_pool.getconn()
+        try:
+            yield connection
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection_pool.putconn(connection, close=connection.closed != 0)
+
+    def upsert_availability(self, centre_rows, station_rows):
+        # Add the aggregator's hourly deltas to the availability tables (schema/availability.sql)
+        # centre_rows: (hour, centre_id, received, duplicates, expected, latency_sum, latency_buckets)
+        # station_rows: (hour, wigos_station_identifier, centre_id, received, duplicates, expected, latency_sum)
+        # Returns True once both are written
+        centre_query = """
+            INSERT INTO availability_hourly_centre
+                (hour, centre_id, received, duplicates, expected, latency_sum, latency_buckets)
+            VALUES %s
+            ON CONFLICT (hour, centre_id) DO UPDATE SET
+                received = availability_hourly_centre.received + EXCLUDED.received,
+                duplicates = availability_hourly_centre.duplicates + EXCLUDED.duplicates,
+                expected = EXCLUDED.expected,
+                latency_sum = availability_hourly_centre.latency_sum + EXCLUDED.latency_sum,
+                latency_buckets = ARRAY(
+                    SELECT coalesce(current, 0) + coalesce(added, 0)
+                    FROM unnest(availability_hourly_centre.latency_buckets, EXCLUDED.latency_buckets) AS buckets(current, added)),
+                updated_at = CURRENT_TIMESTAMP;
         """
-        
-        # Create a new connection for each call
-        with psycopg2.connect(**self.db_config) as connection:
-            try:
+        station_query = """
+            INSERT INTO availability_hourly_station
+                (hour, wigos_station_identifier, centre_id, received, duplicates, expected, latency_sum)
+            VALUES %s
+            ON CONFLICT (hour, wigos_station_identifier) DO UPDATE SET
+                centre_id = coalesce(EXCLUDED.centre_id, availability_hourly_station.centre_id),
+                received = availability_hourly_station.received + EXCLUDED.received,
+                duplicates = availability_hourly_station.duplicates + EXCLUDED.duplicates,
+                expected = EXCLUDED.expected,
+                latency_sum = availability_hourly_station.latency_sum + EXCLUDED.latency_sum,
+                updated_at = CURRENT_TIMESTAMP;
+        """
+        start_time = time.perf_counter()
+        try:
+            with self.connection() as connection:
                 with connection.cursor() as cursor:
-                    for data in data_list:
-                        cursor.execute(query, (data['topic'], data['publication_timestamp'], data['data_id'], data['canonical_url'], data['wigos_station_identifier']))
-                        message_id = cursor.fetchone()[0]
-                        return message_id
-            except Exception as e:
-                # Handle exceptions (log or re-raise)
-                print(f"Error in insert_message_data: {e}")
-                
-    def insert_bufr_data(self, message_id, decoded_data):
-        # Insert BUFR data into the 'bufr' table
-        if message_id is None:
-            raise ValueError("message_id cannot be null.")
+                    if centre_rows:
+                        execute_values(cursor, centre_query, centre_rows, page_size=BUFR_PAGE_SIZE)
+                    if station_rows:
+                        execute_values(cursor, station_query, station_rows, page_size=BUFR_PAGE_SIZE)
+        except Exception as e:
+            logging.error("Error in upsert_availability: %s", e)
+            return False
+        INSERT_SECONDS.labels('availability').observe(time.perf_counter() - start_time)
+        return True
 
-        keys_config = ConfigReader.read_config(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE), 'BUFRKeys')
-        required_columns = keys_config.get('required_columns', '').split(',')
-        additional_columns = keys_config.get('additional_columns', '').split(',')
-        keys = required_columns
+    def fetch_availability(self, hours, stations):
+        # Totals of every ingest instance for these hours from the availability tables:
+        # ({(hour, wigos_station_identifier): received} for the given stations, {(hour, centre_id): latency_buckets})
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                station_received = {}
+                if stations:
+                    cursor.execute("""
+                        SELECT hour, wigos_station_identifier, received FROM availability_hourly_station
+                        WHERE hour = ANY(%s) AND wigos_station_identifier = ANY(%s);
+                    """, (list(hours), list(stations)))
+                    station_received = {(hour, station): received for hour, station, received in cursor.fetchall()}
+                cursor.execute("SELECT hour, centre_id, latency_buckets FROM availability_hourly_centre WHERE hour = ANY(%s);",
+                               (list(hours),))
+                centre_latencies = {(hour, centre_id): latency_buckets for hour, centre_id, latency_buckets in cursor.fetchall()}
+        return station_received, centre_latencies
+
+    def find_archived_messages(self, topic, day):
+        # Messages of a topic published on a day, by the file name of their canonical URL
+        # (the name the file has in the archive); the first message wins for a repeated name
+        query = """
+            SELECT id, publication_timestamp, canonical_url FROM message
+            WHERE topic = %s AND publication_timestamp >= %s AND publication_timestamp < %s + interval '1 day'
+            ORDER BY id;
+        """
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, (topic, day, day))
+                rows = cursor.fetchall()
+        messages = {}
+        for message_id, publication_timestamp, canonical_url in rows:
+            messages.setdefault(os.path.basename(canonical_url or ''), (message_id, publication_timestamp))
+        return messages
 
-        # Create the list of columns for the INSERT query
-        columns = ", ".join(keys + ["raw_data"])
+    def find_messages_without_bufr(self, messages):
+        # Ids of the stored messages among these Message records that have no BUFR row,
+        # by (data_id, publication_timestamp)
+        if not messages:
+            return {}
+        query = """
+            SELECT message.id, message.data_id, message.publication_timestamp
+            FROM message JOIN (VALUES %s) AS replayed (data_id, publication_timestamp)
+                ON message.data_id = replayed.data_id AND message.publication_timestamp = replayed.publication_timestamp
+            WHERE NOT EXISTS (SELECT 1 FROM bufr
+                              WHERE bufr.message_id = message.id AND bufr.publication_timestamp = message.publication_timestamp);
+        """
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                result = execute_values(cursor, query, [(message.data_id, message.publication_timestamp) for message in messages],
+                                        template="(%s, %s::timestamp)", page_size=len(messages), fetch=True)
+        return {(data_id, publication_timestamp): message_id for message_id, data_id, publication_timestamp in result}
 
-        # Create the list of placeholders for the values
-        values_placeholders = ", ".join(["%s"] * len(keys + ["raw_data"]))
+    def maintain_partitions(self, days_ahead=7, retention_days=90):
+        # Create the coming daily partitions of message and bufr and drop the expired ones
+        # (routines from schema/partitions.sql); retention_days <= 0 keeps everything
+        # The creation runs in its own transaction and the drop commits each day, so a failed
+        # drop does not undo the new partitions
+        created = self.call_partition_function('wis2_create_partitions', days_ahead)
+        dropped = 0
+        if int(retention_days) > 0:
+            dropped = self.call_partition_function('wis2_drop_partitions', retention_days, procedure=True)
+        if created is None or dropped is None:
+            return None
+        logging.info("Partitions: %d created, %d dropped", created, dropped)
+        return created, dropped
 
-        # Build the INSERT query with dynamic columns
+    def call_partition_function(self, function, days, procedure=False):
+        # Run one of the partition routines; the days they skip are reported as warnings
+        # A procedure commits as it goes, so it is CALLed outside a transaction block (autocommit)
+        try:
+            with self.connection() as connection:
+                connection.autocommit = procedure
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"{'CALL' if procedure else 'SELECT'} {function}(%s)", (int(days),))
+                        result = cursor.fetchone()[0]
+                finally:
+                    if procedure and not connection.closed:
+                        connection.autocommit = False
+                for notice in connection.notices:
+                    logging.warning("%s: %s", function, notice.strip().split(':  ', 1)[-1])
+                del connection.notices[:]
+        except Exception as e:
+            logging.error("Error in %s: %s", function, e)
+            return None
+        return result
+
+    def close(self):
+        # Close every pooled connection owned by this process
+        if self.pool is not None and self.pool_pid == os.getpid():
+            self.pool.closeall()
+        self.pool = None
+        self.pool_pid = None
+
+    def insert_messages(self, messages):
+        # Insert a whole batch of Message records (notification.py) in one round trip
+        # Returns the new ids in the same order as messages, with None for
+        # messages already stored (same data_id and publication_timestamp)
+        if not messages:
+            return []
+
+        # The hourly rollups are updated from the rows actually inserted, in the same statement
         query = f"""
-            INSERT INTO bufr (
-                message_id, {columns}
-            ) VALUES (
-                %s, {values_placeholders}
-            );
+            WITH inserted AS (
+                INSERT INTO message ({", ".join(MESSAGE_COLUMNS)})
+                VALUES %s
+                ON CONFLICT (data_id, publication_timestamp) DO NOTHING
+                RETURNING id, data_id, publication_timestamp, topic, wigos_station_identifier,
+                          EXTRACT(EPOCH FROM insert_timestamp - publication_timestamp) AS latency
+            ), centre_rollup AS ({HOURLY_CENTRE_ROLLUP}
+            ), station_rollup AS ({HOURLY_STATION_ROLLUP}
+            )
+            SELECT id, data_id, publication_timestamp FROM inserted;
         """
+        rows = [MESSAGE_ROW(message) for message in messages]
 
-        # Create a new connection for each call
-        with psycopg2.connect(**self.db_config) as connection:
-            try:
+        start_time = time.perf_counter()
+        try:
+            with self.connection() as connection:
                 with connection.cursor() as cursor:
-                    for message_data in decoded_data['messages']:
-                        # Reset the values list for each message
-                        values = [message_id]
+                    result = execute_values(cursor, query, rows, page_size=len(rows), fetch=True)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The database is unreachable: let the batch fail so a spooled batch is not acked
+            raise
+        except psycopg2.DataError as e:
+            # A value the table rejects (e.g. a canonical_url longer than its column) fails the whole
+            # statement: insert the rows one by one so only the bad ones are dropped
+            logging.warning("Error in insert_messages, inserting the batch row by row: %s", e)
+            result = self.insert_message_rows(query, rows)
+        except Exception as e:
+            logging.error("Error in insert_messages: %s", e)
+            return []
+        INSERT_SECONDS.labels('message').observe(time.perf_counter() - start_time)
+        ROWS_PER_STATEMENT.labels('message').observe(len(rows))
 
-                        for key in keys:
-                            value = message_data.get(key.strip(), None)
-                            values.append(value)
+        # Match the inserted rows back to the batch; a key repeated within the batch
+        # only gets an id the first time
+        inserted = {(data_id, publication_timestamp): message_id for message_id, data_id, publication_timestamp in result}
+        return [inserted.pop((message.data_id, message.publication_timestamp), None) for message in messages]
 
-                        # Add the 'raw_data' column with all data in JSON format
-                        keys = required_columns + additional_columns
-                        raw_data = {k: message_data.get(k.strip(), None) for k in keys}
-                        values.append(json.dumps(raw_data))
+    def insert_message_rows(self, query, rows):
+        # Run the insert_messages query for each row on its own; returns the inserted (id, data_id, publication_timestamp)
+        result = []
+        for row in rows:
+            try:
+                with self.connection() as connection:
+                    with connection.cursor() as cursor:
+                        result.extend(execute_values(cursor, query, [row], fetch=True))
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except Exception as e:
+                DROPPED.labels('invalid_row').inc()
+                logging.error("Message %s rejected: %s", row[2], e)
+        return result
 
-                        sql_query = cursor.mogrify(query, values)
-                        cursor.execute(sql_query)
+    def insert_bufr_batch(self, decoded_batch, replace=False):
+        # Insert the decoded BUFR columns of several messages with multi-row VALUES
+        # decoded_batch is a list of (message_id, publication_timestamp, DecodedBatch) tuples, the
+        # publication_timestamp of the message being the partition key of bufr; every subset becomes a row
+        # With replace, the existing rows of these messages are deleted in the same transaction (backfill)
+        required_columns = list(BufrSchema.load(os.path.join(CONFIG_DIR, BUFR_KEYS_FILE)).required_columns)
 
-            except Exception as e:
-                # Handle exceptions (log or re-raise)
-                print(f"Error in insert_bufr_data: {e}")
+        rows = []
+        for message_id, publication_timestamp, decoded_data in decoded_batch:
+            if message_id is None:
+                raise ValueError("message_id cannot be null.")
+            row_count = decoded_data.row_count
+            # Rows are zipped from the columns, each converted once with None for missing values
+            columns = [decoded_data.column_list(key) for key in required_columns]
+            # Add the 'raw_data' column with all data in JSON format
+            raw_data = decoded_data.raw_json() if self.store_raw_data else repeat(None, row_count)
+            rows.extend(zip(repeat(message_id, row_count), repeat(publication_timestamp, row_count), *columns, raw_data))
+
+        if not rows and not replace:
+            return 0
+
+        # Build the INSERT query with dynamic columns
+        columns = ", ".join(required_columns + ["raw_data"])
+        query = f"""
+            INSERT INTO bufr (
+                message_id, publication_timestamp, {columns}
+            ) VALUES %s;
+        """
+
+        start_time = time.perf_counter()
+        try:
+            with self.connection() as connection:
+                with connection.cursor() as cursor:
+                    if replace:
+                        replaced = list({(message_id, publication_timestamp) for message_id, publication_timestamp, _ in decoded_batch})
+                        execute_values(cursor, DELETE_BUFR_QUERY, replaced, template="(%s, %s::timestamp)",
+                                       page_size=BUFR_PAGE_SIZE)
+                    execute_values(cursor, query, rows, page_size=BUFR_PAGE_SIZE)
+            INSERT_SECONDS.labels('bufr').observe(time.perf_counter() - start_time)
+            for page_start in range(0, len(rows), BUFR_PAGE_SIZE):
+                ROWS_PER_STATEMENT.labels('bufr').observe(min(BUFR_PAGE_SIZE, len(rows) - page_start))
+            return len(rows)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The database is unreachable: let the batch fail so a spooled batch is not acked
+            # (its messages are then recovered by DataProcessor.recover_replayed)
+            raise
+        except Exception as e:
+            logging.error("Error in insert_bufr_batch: %s", e)
+            return 0
@@ -0,0 +1,131 @@
+# decoded_batch.py
+import json
+
+import numpy as np
+
+from config_reader import ConfigReader
+
+class BufrSchema:
+    # The BUFR keys to decode, resolved once per BUFRKeys.ini version:
+    # the position of every key, its column type and its JSON prefix in raw_data
+    # The types are fixed by the configuration ([BUFRKeyTypes]), never by the data, so every
+    # file gives the same columns: int64 for integer keys, object (str) for string keys, float64 otherwise
+    __slots__ = ('required_columns', 'keys', 'positions', 'dtypes', 'json_prefixes')
+
+    def __init__(self, required_columns, additional_columns, integer_keys=(), string_keys=()):
+        self.required_columns = tuple(required_columns)
+        self.keys = tuple(dict.fromkeys(self.required_columns + tuple(additional_columns)))
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        integer_keys = set(integer_keys)
+        string_keys = set(string_keys)
+        self.dtypes = tuple(np.dtype(np.int64) if key in integer_keys else np.dtype(object) if key in string_keys
+                            else np.dtype(np.float64) for key in self.keys)
+        self.json_prefixes = tuple(f"{json.dumps(key)}: " for key in self.keys)
+
+    @staticmethod
+    def load(file_path):
+        # Schema of a BUFRKeys.ini file, cached until the file is reloaded
+        def build(config):
+            bufr_keys = ConfigReader.bufr_keys(file_path)
+            return BufrSchema(bufr_keys.required_columns, bufr_keys.additional_columns,
+                              bufr_keys.integer_keys, bufr_keys.string_keys)
+        return ConfigReader.derived(file_path, 'bufr_schema', build)
+
+def coerce(values, mask, dtype):
+    # (values, mask) converted to a column type; values that do not convert are masked
+    if values.dtype == dtype:
+        return values, mask
+    mask = mask.copy()
+    if dtype == object:
+        return np.array([str(value) for value in values.tolist()], dtype=object), mask
+    if values.dtype == object:
+        converted = np.zeros(len(values), dtype=dtype)
+        for index, value in enumerate(values.tolist()):
+            try:
+                converted[index] = float(value) if dtype.kind == 'f' else int(float(value))
+            except (TypeError, ValueError, OverflowError):
+                mask[index] = True
+        return converted, mask
+    if dtype.kind == 'i':
+        # Float values of an integer key; missing and non-finite ones are masked
+        valid = ~mask & np.isfinite(values) & (np.abs(values) < 2 ** 63)
+        mask |= ~valid
+        return np.where(valid, np.round(np.where(valid, values, 0)), 0).astype(np.int64), mask
+    return values.astype(dtype), mask
+
+class DecodedBatch:
+    # The observations decoded from one file, column-wise: for every schema key an array of the
+    # schema's type for that key with one entry per subset and a boolean mask set where the value
+    # is missing
+    __slots__ = ('schema', 'row_count', 'message_count', 'message_number', 'values', 'masks', 'decode_seconds')
+
+    def __init__(self, schema, message_number, values, masks, message_count, decode_seconds=0.0):
+        self.schema = schema
+        self.row_count = len(message_number)
+        self.message_count = message_count
+        self.message_number = message_number
+        self.values = values
+        self.masks = masks
+        self.decode_seconds = decode_seconds
+
+    @classmethod
+    def from_parts(cls, schema, subset_counts, parts, decode_seconds=0.0):
+        # Join the (values, mask) parts of every BUFR message, parts[key position][message number]
+        # being None when the key is absent from that message; each part is converted to the
+        # schema's type of its key
+        message_number = (np.repeat(np.arange(len(subset_counts), dtype=np.int32), subset_counts)
+                          if subset_counts else np.empty(0, dtype=np.int32))
+        values = []
+        masks = []
+        for dtype, key_parts in zip(schema.dtypes, parts):
+            value_parts = []
+            mask_parts = []
+            for part, subset_count in zip(key_parts, subset_counts):
+                if part is None:
+                    value_parts.append(np.zeros(subset_count, dtype=dtype) if dtype != object
+                                       else np.full(subset_count, None, dtype=object))
+                    mask_parts.append(np.ones(subset_count, dtype=bool))
+                else:
+                    part_values, part_mask = coerce(part[0], part[1], dtype)
+                    value_parts.append(part_values)
+                    mask_parts.append(part_mask)
+            values.append(np.concatenate(value_parts) if value_parts else np.empty(0, dtype=dtype))
+            masks.append(np.concatenate(mask_parts) if mask_parts else np.empty(0, dtype=bool))
+        return cls(schema, message_number, values, masks, len(subset_counts), decode_seconds)
+
+    def column(self, key):
+        # (values, mask) of a key, None when the key is not part of the schema
+        position = self.schema.positions.get(key)
+        if position is None:
+            return None
+        return self.values[position], self.masks[position]
+
+    def column_list(self, key):
+        # Plain Python values of a key with None where missing (what the database driver adapts)
+        column = self.column(key)
+        if column is None:
+            return [None] * self.row_count
+        values, mask = column
+        result = values.tolist()
+        for index in np.flatnonzero(mask).tolist():
+            result[index] = None
+        return result
+
+    def raw_json(self):
+        # The raw_data JSON object of every row, encoded column by column
+        if not self.schema.keys:
+            return ['{}'] * self.row_count
+        encoded = []
+        for prefix, values, mask in zip(self.schema.json_prefixes, self.values, self.masks):
+            if values.dtype == object:
+                texts = [prefix + json.dumps(value) for value in values.tolist()]
+            else:
+                # int and float reprs are their JSON encoding
+                texts = [prefix + repr(value) for value in values.tolist()]
+            for index in np.flatnonzero(mask).tolist():
+                texts[index] = prefix + 'null'
+            encoded.append(texts)
+        return ['{' + ', '.join(parts) + '}' for parts in zip(*encoded)]
+
+    def __repr__(self):
+        return f"DecodedBatch({self.message_count} messages, {self.row_count} rows, {len(self.schema.keys)} keys)"
@@ -0,0 +1,54 @@
+# dedup_cache.py
+import time
+from collections import OrderedDict
+
+class DedupCache:
+    def __init__(self, max_size=100000, ttl=86400):
+        # Bounded LRU set of recently seen notification keys, each expiring after ttl seconds
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def notification_key(notification):
+        # Identify a queued notification tuple by data_id and pubtime,
+        # falling back to the notification id when those are not available
+        _, notification_id, pubtime, data_id = notification[:4]
+        if data_id != 'N/A' and pubtime != 'N/A':
+            return (data_id, pubtime)
+        if notification_id:
+            return ('id', notification_id)
+        return None
+
+    def seen(self, key, now=None):
+        # Record key and return True if it was already seen within the ttl
+        if key is None:
+            return False
+        now = time.monotonic() if now is None else now
+
+        seen_at = self.entries.get(key)
+        if seen_at is not None and now - seen_at < self.ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        self.misses += 1
+
+        # Evict expired entries from the old end, then enforce the size bound
+        while self.entries:
+            oldest_key, oldest_at = next(iter(self.entries.items()))
+            if now - oldest_at < self.ttl and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+        return False
+
+    def forget(self, key):
+        # Drop a key so that its next occurrence is treated as new
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
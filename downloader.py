@@ -0,0 +1,203 @@
+# downloader.py
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import counter, histogram
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+DOWNLOAD_SECONDS = histogram('wis2_download_seconds', "Time to download a file, by origin host", ('host',))
+DOWNLOAD_ERRORS = counter('wis2_download_errors_total', "Downloads that failed after retries, by origin host", ('host',))
+DOWNLOAD_RETRIES = counter('wis2_download_retries_total', "Download attempts retried, by origin host", ('host',))
+
+class HostMetrics:
+    def __init__(self):
+        # Per-host download counters, updated under the Downloader lock
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+class Downloader:
+    def __init__(self, workers=8, per_host=4, connect_timeout=5.0, read_timeout=30.0,
+                 retries=3, backoff=0.5, chunk_size=65536):
+        # Concurrent HTTP downloader sharing keep-alive connections per origin host
+        self.workers = max(1, int(workers))
+        self.per_host = max(1, int(per_host))
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.retries = max(0, int(retries))
+        self.backoff = float(backoff)
+        self.chunk_size = int(chunk_size)
+
+        self.lock = threading.Lock()
+        self.host_limits = {}
+        self.metrics = {}
+        self.session = None
+        self.executor = None
+        self.owner_pid = None
+
+    @classmethod
+    def from_config(cls, downloader_config):
+        # Build a Downloader from the [Downloader] section of general_config.ini
+        return cls(workers=downloader_config.get('Workers', 8),
+                   per_host=downloader_config.get('PerHostConnections', 4),
+                   connect_timeout=downloader_config.get('ConnectTimeout', 5),
+                   read_timeout=downloader_config.get('ReadTimeout', 30),
+                   retries=downloader_config.get('Retries', 3),
+                   backoff=downloader_config.get('Backoff', 0.5))
+
+    def setup(self):
+        # The session and thread pool are created lazily so they never cross a fork
+        if self.owner_pid == os.getpid():
+            return
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=self.per_host, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='download')
+        self.host_limits = {}
+        self.metrics = {}
+        self.owner_pid = os.getpid()
+
+    def close(self):
+        if self.owner_pid != os.getpid():
+            return
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        self.owner_pid = None
+
+    def host_state(self, host):
+        # Concurrency limit and metrics for one origin host
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+                self.metrics[host] = HostMetrics()
+            return self.host_limits[host], self.metrics[host]
+
+    def download(self, url, local_path):
+        # Stream a URL to local_path, retrying transient failures
+        self.request_with_retries(url, lambda response: self.stream_to_file(response, local_path))
+        return local_path
+
+    def fetch(self, url):
+        # Read a URL into memory, retrying transient failures
+        return self.request_with_retries(url, self.read_body)
+
+    def request_with_retries(self, url, consume):
+        # GET a URL and hand the response to consume(response), which returns the body,
+        # retrying connection errors, timeouts and 429/5xx with exponential backoff
+        self.setup()
+        host = urlsplit(url).netloc
+        limit, metrics = self.host_state(host)
+
+        attempt = 0
+        while True:
+            start_time = time.monotonic()
+            try:
+                with limit:
+                    with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                        response.raise_for_status()
+                        body = consume(response)
+                elapsed = time.monotonic() - start_time
+                with self.lock:
+                    metrics.requests += 1
+                    metrics.bytes += len(body) if isinstance(body, bytes) else body
+                    metrics.latency_total += elapsed
+                    metrics.latency_max = max(metrics.latency_max, elapsed)
+                DOWNLOAD_SECONDS.labels(host).observe(elapsed)
+                return body
+
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                retryable = isinstance(e, RETRY_EXCEPTIONS) or status in RETRY_STATUS_CODES
+                if not retryable or attempt >= self.retries:
+                    with self.lock:
+                        metrics.requests += 1
+                        metrics.errors += 1
+                    DOWNLOAD_ERRORS.labels(host).inc()
+                    raise
+                with self.lock:
+                    metrics.retries += 1
+                DOWNLOAD_RETRIES.labels(host).inc()
+                delay = self.backoff * (2 ** attempt)
+                logging.debug("Retrying %s in %.1fs after error: %s", url, delay, e)
+                time.sleep(delay)
+                attempt += 1
+
+    def stream_to_file(self, response, local_path):
+        # Write the response body in chunks to a temporary file, then move it into place
+        # Returns the number of bytes written
+        temp_path = f"{local_path}.part"
+        size = 0
+        try:
+            with open(temp_path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, local_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return size
+
+    def read_body(self, response):
+        # Collect the response body chunk by chunk into a single buffer
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            body += chunk
+        return bytes(body)
+
+    def download_many(self, jobs):
+        # Download (url, local_path) jobs concurrently
+        # Returns a list of (local_path, error) in the same order as jobs
+        self.setup()
+        return self.gather([self.executor.submit(self.download, url, local_path) for url, local_path in jobs])
+
+    def fetch_many(self, urls):
+        # Read several URLs into memory concurrently
+        # Returns a list of (bytes, error) in the same order as urls
+        self.setup()
+        return self.gather([self.executor.submit(self.fetch, url) for url in urls])
+
+    def gather(self, futures):
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                logging.debug(traceback.format_exc())
+                results.append((None, e))
+        return results
+
+    def stats(self):
+        # Snapshot of the per-host latency and error metrics
+        with self.lock:
+            return {
+                host: {
+                    'requests': metrics.requests,
+                    'errors': metrics.errors,
+                    'retries': metrics.retries,
+                    'bytes': metrics.bytes,
+                    'latency_mean': metrics.latency_total / max(1, metrics.requests - metrics.errors),
+                    'latency_max': metrics.latency_max
+                }
+                for host, metrics in self.metrics.items()
+            }
+
+    def log_stats(self):
+        for host, metrics in self.stats().items():
+            logging.info("Downloads from %s: %d requests, %d errors, %d retries, mean %.3fs, max %.3fs",
+                         host, metrics['requests'], metrics['errors'], metrics['retries'],
+                         metrics['latency_mean'], metrics['latency_max'])
@@ -0,0 +1,96 @@
+# flush_scheduler.py
+import logging
+import time
+
+from metrics import gauge
+
+BATCH_TARGET = gauge('wis2_batch_size_target', "Batch size the dispatcher currently flushes at")
+
+class FlushScheduler:
+    def __init__(self, batch_size=50, min_batch_size=10, max_batch_size=500, max_staleness=5,
+                 target_batch_seconds=10, adapt_interval=5, idle_timeout=1):
+        # Decides when the dispatcher hands its buffer to the workers:
+        # - a notification never waits more than max_staleness seconds in the buffer, even when
+        #   the queue goes quiet (the wait for the next notification is cut to the deadline);
+        # - the batch size follows the backlog, between min_batch_size and max_batch_size: small
+        #   batches while the workers keep up, larger ones to amortize the download and DB round
+        #   trips when notifications pile up, capped so a batch takes about target_batch_seconds
+        #   of worker time at the observed seconds per message
+        self.min_batch_size = max(1, int(min_batch_size))
+        self.max_batch_size = max(self.min_batch_size, int(max_batch_size))
+        self.batch_size = min(max(int(batch_size), self.min_batch_size), self.max_batch_size)
+        self.max_staleness = float(max_staleness)
+        self.target_batch_seconds = float(target_batch_seconds)
+        self.adapt_interval = float(adapt_interval)
+        self.idle_timeout = float(idle_timeout)
+
+        self.oldest = None
+        self.seconds_per_message = None
+        self.last_totals = None
+        self.last_adapt_time = time.monotonic()
+        BATCH_TARGET.set(self.batch_size)
+
+    @classmethod
+    def from_config(cls, processor_config):
+        # Build the scheduler from the [Processor] section of general_config.ini
+        # (FlushInterval is the former name of MaxStaleness)
+        return cls(batch_size=processor_config.get('BatchSize', 50),
+                   min_batch_size=processor_config.get('MinBatchSize', 10),
+                   max_batch_size=processor_config.get('MaxBatchSize', 500),
+                   max_staleness=processor_config.get('MaxStaleness', processor_config.get('FlushInterval', 5)),
+                   target_batch_seconds=processor_config.get('TargetBatchSeconds', 10),
+                   adapt_interval=processor_config.get('AdaptInterval', 5))
+
+    def added(self):
+        # A notification entered the buffer; the first one starts the staleness clock
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    def timeout(self):
+        # Seconds to wait for the next notification before the buffer must be flushed
+        if self.oldest is None:
+            return self.idle_timeout
+        return max(0.0, min(self.idle_timeout, self.oldest + self.max_staleness - time.monotonic()))
+
+    def due(self, buffered):
+        # Flush reason for a buffer of that many notifications, None while it can wait
+        if not buffered:
+            return None
+        if buffered >= self.batch_size:
+            return 'size'
+        if time.monotonic() - self.oldest >= self.max_staleness:
+            return 'timer'
+        return None
+
+    def flushed(self):
+        self.oldest = None
+
+    def maybe_adapt(self, backlog, worker_stats):
+        # Called from the dispatcher loop; resizes at most every adapt_interval seconds
+        # backlog() is the number of notifications waiting, worker_stats() the BatchWorkerPool stats
+        if time.monotonic() - self.last_adapt_time >= self.adapt_interval:
+            self.adapt(backlog(), worker_stats())
+
+    def adapt(self, backlog, worker_stats):
+        self.last_adapt_time = time.monotonic()
+
+        # Worker seconds (download, decode and DB inserts) per message since the last call
+        totals = (sum(worker['busy_seconds'] for worker in worker_stats),
+                  sum(worker['messages'] for worker in worker_stats))
+        if self.last_totals is not None and totals[1] > self.last_totals[1]:
+            self.seconds_per_message = (totals[0] - self.last_totals[0]) / (totals[1] - self.last_totals[1])
+        self.last_totals = totals
+
+        # One batch per worker out of what is waiting, bounded by the batch duration target
+        target = backlog // max(1, len(worker_stats))
+        if self.seconds_per_message:
+            target = min(target, int(self.target_batch_seconds / self.seconds_per_message))
+        target = min(max(target, self.min_batch_size), self.max_batch_size)
+
+        # Move halfway towards the target so a single burst does not swing the size
+        batch_size = (self.batch_size + target + (1 if target > self.batch_size else 0)) // 2
+        if batch_size != self.batch_size:
+            logging.debug("Batch size %d -> %d (backlog %d, %.3fs per message)", self.batch_size, batch_size,
+                          backlog, self.seconds_per_message or 0.0)
+            self.batch_size = batch_size
+            BATCH_TARGET.set(batch_size)
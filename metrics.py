@@ -0,0 +1,282 @@
+# metrics.py
+import bisect
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Full
+
+# Every process records into its own registry with plain in-memory increments.
+# Child processes push a snapshot of their registry to the parent every few seconds;
+# the parent merges them with its own values and serves the Prometheus text format.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values):
+        # Cache one child per label combination; the hot path is a dict lookup
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def snapshot(self):
+        return {labels: child.value for labels, child in list(self.children.items())}
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def reset(self):
+        self.value = 0
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.function = None
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        # Read the value when the metrics are collected (e.g. a queue size)
+        self.function = function
+
+    def snapshot(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except (NotImplementedError, OSError, ValueError):
+                pass
+        return super().snapshot()
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def snapshot(self):
+        return {labels: (list(child.counts), child.sum, child.count) for labels, child in list(self.children.items())}
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def reset(self):
+        # Forget the values inherited from the parent after a fork
+        # (in place, so children already held by callers stay registered)
+        for metric in self.metrics.values():
+            for child in metric.children.values():
+                child.reset()
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+# Queue used by child processes to push their snapshots; created by the parent before forking
+collector_queue = None
+
+def enable_collection():
+    # Call in the parent process before starting the processes that should report
+    global collector_queue
+    collector_queue = multiprocessing.Queue(maxsize=1000)
+
+def start_pusher(interval=5.0):
+    # Push this process's metrics to the parent every interval seconds
+    if collector_queue is None:
+        return
+    REGISTRY.reset()
+
+    def push():
+        while True:
+            time.sleep(interval)
+            push_now()
+
+    threading.Thread(target=push, name='metrics-pusher', daemon=True).start()
+
+def push_now():
+    # Send the current snapshot right away, e.g. just before a child process exits
+    if collector_queue is None:
+        return
+    try:
+        collector_queue.put_nowait((os.getpid(), REGISTRY.snapshot()))
+    except Full:
+        pass
+    except Exception as e:
+        logging.debug("Could not push metrics: %s", e)
+
+class MetricsServer:
+    def __init__(self, port, host='127.0.0.1'):
+        # Serves the merged metrics of this process and its children on /metrics
+        self.port = int(port)
+        self.host = host
+        self.remote = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        if collector_queue is not None:
+            threading.Thread(target=self.collect, name='metrics-collector', daemon=True).start()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+        logging.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def collect(self):
+        # Keep the latest snapshot of every child process
+        while True:
+            try:
+                source, snapshot = collector_queue.get(timeout=1)
+            except Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            with self.lock:
+                self.remote[source] = snapshot
+
+    def merged(self):
+        # Sum the local registry and the latest snapshot of every child
+        # (gauges too: a gauge describing shared state must be set in one process only)
+        with self.lock:
+            snapshots = [REGISTRY.snapshot()] + list(self.remote.values())
+        merged = {}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                target = merged.setdefault(name, {})
+                for labels, value in series.items():
+                    if labels not in target:
+                        target[labels] = (list(value[0]), value[1], value[2]) if isinstance(value, tuple) else value
+                    elif isinstance(value, tuple):
+                        counts, total, count = target[labels]
+                        target[labels] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+                    else:
+                        target[labels] += value
+        return merged
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        merged = self.merged()
+        for name, metric in sorted(REGISTRY.metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in sorted(merged.get(name, {}).items()):
+                label_text = ','.join(f'{key}="{escape(value)}"' for key, value in zip(metric.labelnames, labels))
+                if metric.kind != 'histogram':
+                    lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                prefix = f"{label_text}," if label_text else ''
+                for bound, bucket_count in zip(list(metric.buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                suffix = f"{{{label_text}}}" if label_text else ''
+                lines.append(f"{name}_sum{suffix} {total}")
+                lines.append(f"{name}_count{suffix} {count}")
+        return '\n'.join(lines) + '\n'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
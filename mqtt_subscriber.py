@@ -1,22 +1,49 @@
 # mqtt_subscriber.py
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import logging
+import socket
 import time
 import ssl
 import json
-import re
 import os
+import traceback
 from queue import Queue
 from config_reader import ConfigReader
+from notification import NOT_ALLOWED_EXTENSIONS, compact_notification, topic_centre
+import metrics
 
 CONFIG_DIR = 'config'
 GENERAL_CONFIG_FILE = 'general_config.ini'
 MQTT_CONFIG_FILE = 'mqtt_config.ini'
 
+STATS_INTERVAL = 60
+DEFAULT_TOPIC = 'cache/a/wis2/+/+/+/core/+/surface-based-observations/synop'
+
+RECEIVED = metrics.counter('wis2_messages_received_total', "Notifications received from the broker")
+DROPPED = metrics.counter('wis2_messages_dropped_total', "Notifications dropped, by reason", ('reason',))
+
 class MqttSubscriber:
-    def __init__(self, gs, mqtt_config, queue):
+    def __init__(self, gs, mqtt_config, queue, index=0):
+        # Subscription settings; with SharedGroup set, every instance joins the MQTT v5 shared
+        # subscription $share/<group>/<topic> and the broker spreads the stream between them
+        self.topic = mqtt_config.get('Topic', DEFAULT_TOPIC)
+        self.shared_group = mqtt_config.get('SharedGroup', '')
+        self.qos = int(mqtt_config.get('QoS', 1 if self.shared_group else 0))
+        self.clean_session = str(mqtt_config.get('CleanSession', 'false' if self.shared_group else 'true')).lower() == 'true'
+        self.session_expiry = int(mqtt_config.get('SessionExpiry', 3600))
+
+        # A stable client id lets the broker keep the session (and queue QoS 1 messages)
+        # across restarts; index tells apart the subscribers of one instance
+        self.instance_id = mqtt_config.get('InstanceId', '') or socket.gethostname()
+        self.client_id = f"{mqtt_config.get('ClientIdPrefix', 'wis2-data-analysis')}-{self.instance_id}-{index}"
+
         # Initialize MQTT client
-        self.client = mqtt.Client()
+        if self.shared_group:
+            self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client(client_id=self.client_id, clean_session=self.clean_session)
         # Set up TLS configuration
         self.client.tls_set(ca_certs=None, certfile=None, keyfile=None,
                             cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLS,
@@ -34,45 +61,89 @@ class MqttSubscriber:
         self.queue = queue
         self.is_running = False
 
+        # Messages dropped before reaching the queue, by reason
+        self.dropped = {reason: DROPPED.labels(reason) for reason in ('blacklist', 'extension', 'invalid')}
+        self.accepted = 0
+        self.last_stats_time = time.time()
+
     def connect(self):
         # Connect to the MQTT broker
-        self.client.connect(self.broker_address, self.port, keepalive=60)
+        if self.shared_group:
+            # MQTT v5: the session outlives the connection for SessionExpiry seconds
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = 0 if self.clean_session else self.session_expiry
+            self.client.connect(self.broker_address, self.port, keepalive=60,
+                                clean_start=self.clean_session, properties=properties)
+        else:
+            self.client.connect(self.broker_address, self.port, keepalive=60)
         # Start the MQTT loop in a blocking manner
         self.client.loop_forever()
         self.is_running = True
 
-    def on_connect(self, client, userdata, flags, rc):
+    def subscription(self):
+        # Topic filter to subscribe to, shared between the instances of the group if configured
+        if self.shared_group:
+            return f"$share/{self.shared_group}/{self.topic}"
+        return self.topic
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         # Callback function when the client connects to the MQTT broker
+        # (properties is only passed for MQTT v5 connections)
         if rc == 0:
-            logging.info("Connected to the MQTT broker")
+            logging.info("Connected to the MQTT broker as %s (session present: %s)",
+                         self.client_id, flags.get('session present', 0))
             # Subscribe to a specific MQTT topic
-            client.subscribe("cache/a/wis2/+/+/+/core/+/surface-based-observations/synop")
+            client.subscribe(self.subscription(), qos=self.qos)
         else:
-            logging.error("Connection failed, return code = %d", rc)
+            logging.error("Connection failed, return code = %s", rc)
 
     def on_message(self, client, userdata, msg):
         # Callback function when a message is received
+        # The cheap topic check runs first so blacklisted centres are never JSON-decoded,
+        # and only a compact tuple of the needed fields crosses the process boundary
+        if time.time() - self.last_stats_time >= STATS_INTERVAL:
+            self.log_stats()
+
+        RECEIVED.inc()
         try:
+            blacklist = ConfigReader.blacklist_matcher(os.path.join(CONFIG_DIR, GENERAL_CONFIG_FILE))
+            if blacklist.search(topic_centre(msg.topic)):
+                self.dropped['blacklist'].inc()
+                return
+
             # Decode JSON payload
-            data = json.loads(msg.payload.decode())
-            payload = {
-                'data': data,
-                'topic': msg.topic
-            }
-            logging.info(f"Received message: {payload}")
-            # Put the payload into the message queue
-            self.queue.put(payload)
-        
-        except json.JSONDecodeError as e:
+            notification = compact_notification(msg.topic, json.loads(msg.payload))
+
+            if blacklist.search(notification[3]):
+                self.dropped['blacklist'].inc()
+                return
+            if notification[4].lower().endswith(NOT_ALLOWED_EXTENSIONS):
+                self.dropped['extension'].inc()
+                return
+
+            logging.debug("Received message on %s: %s", msg.topic, notification[3])
+            # Put the notification into the message queue
+            self.queue.put(notification)
+            self.accepted += 1
+
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            self.dropped['invalid'].inc()
             logging.error("JSON decoding error: %s", e)
             logging.debug("Original JSON payload: %s", msg.payload)
             logging.debug(traceback.format_exc())
         except Exception as e:
+            self.dropped['invalid'].inc()
             logging.error("An unexpected error occurred: %s", e)
             logging.debug(traceback.format_exc())
 
+    def log_stats(self):
+        logging.info("MQTT subscriber: %d messages queued, dropped %s", self.accepted,
+                     {reason: child.value for reason, child in self.dropped.items()})
+        self.last_stats_time = time.time()
+
     def start(self):
-        # Start the MQTT client
+        # Start the MQTT client, reporting metrics to the parent process when it collects them
+        metrics.start_pusher()
         self.connect()
 
     def stop(self):
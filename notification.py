@@ -0,0 +1,94 @@
+# notification.py
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# Fields put on the queue for every accepted notification, in this order
+NOTIFICATION_FIELDS = ('topic', 'notification_id', 'pubtime', 'data_id', 'canonical_url', 'wigos_station_identifier')
+NOT_ALLOWED_EXTENSIONS = ('.png', '.jpeg', '.jpg')
+
+# Compiled once for every notification
+SYNOP_TOPIC_PATTERN = re.compile(r'wis2/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/synop')
+# ISO 8601 forms datetime.fromisoformat does not accept before Python 3.11:
+# any fraction precision, "," as decimal mark, offsets without a colon, basic format
+ISO_PATTERN = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})[T ](\d{2}):?(\d{2}):?(\d{2})(?:[.,](\d+))?'
+                         r'(?:([Zz])|([+-])(\d{2}):?(\d{2}))?$')
+
+# A notification ready for the database and the archive; archive_directory is <topic>/<YYYYMMDD>,
+# the directory of its file under DownloadDirectory
+Message = namedtuple('Message', ('topic', 'publication_timestamp', 'data_id', 'canonical_url',
+                                 'wigos_station_identifier', 'archive_directory'))
+
+def compact_notification(topic, data):
+    # Reduce a decoded WIS2 notification to the tuple of fields the processor needs
+    properties = data.get('properties', {})
+    canonical_url = 'N/A'
+    for link in data.get('links', ()):
+        if link.get('rel') == 'canonical':
+            canonical_url = link['href']
+            break
+    return (topic,
+            data.get('id'),
+            properties.get('pubtime', 'N/A'),
+            properties.get('data_id', 'N/A'),
+            canonical_url,
+            properties.get('wigos_station_identifier', 'N/A'))
+
+def topic_centre(topic):
+    # Centre segments of a WIS2 topic: everything between "wis2" and the "data" level
+    segments = topic.split('/')
+    try:
+        start = segments.index('wis2') + 1
+    except ValueError:
+        return ''
+    end = segments.index('data', start) if 'data' in segments[start:] else start + 1
+    return '/'.join(segments[start:end])
+
+def parse_pubtime(pubtime):
+    # Naive UTC datetime of an ISO 8601 pubtime ("Z" or an offset, any fraction precision),
+    # None when it is missing or malformed
+    # The usual "...SSZ" and "...SS.ffffffZ" forms go straight to datetime.fromisoformat
+    try:
+        if pubtime[-1:] == 'Z':
+            parsed = datetime.fromisoformat(pubtime[:-1])
+            if parsed.tzinfo is None:
+                return parsed
+        else:
+            parsed = datetime.fromisoformat(pubtime)
+    except (TypeError, ValueError):
+        return parse_irregular_pubtime(pubtime)
+    if parsed.tzinfo is None:
+        return parsed
+    offset = parsed.utcoffset()
+    return parsed.replace(tzinfo=None) - offset
+
+def parse_irregular_pubtime(pubtime):
+    # Slow path of parse_pubtime
+    match = ISO_PATTERN.match(pubtime) if isinstance(pubtime, str) else None
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, _, sign, offset_hours, offset_minutes = match.groups()
+    try:
+        parsed = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                          int(fraction[:6].ljust(6, '0')) if fraction else 0)
+    except ValueError:
+        return None
+    if sign:
+        offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        parsed = parsed - offset if sign == '+' else parsed + offset
+    return parsed
+
+def parse_message(notification):
+    # Build the Message of a notification tuple (NOTIFICATION_FIELDS order)
+    # Returns None for files that are not stored (images); raises ValueError for a malformed pubtime
+    topic, _, pubtime, data_id, canonical_url, wigos_station_identifier = notification
+    if canonical_url.lower().endswith(NOT_ALLOWED_EXTENSIONS):
+        return None
+    publication_timestamp = parse_pubtime(pubtime)
+    if publication_timestamp is None:
+        raise ValueError(f"Invalid pubtime {pubtime!r} for {data_id}")
+
+    match = SYNOP_TOPIC_PATTERN.search(topic)
+    topic = match.group(0) if match else 'N/A'
+    return Message(topic, publication_timestamp, data_id, canonical_url, wigos_station_identifier,
+                   f"{topic}/{publication_timestamp:%Y%m%d}")
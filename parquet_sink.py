@@ -0,0 +1,190 @@
+# parquet_sink.py
+import logging
+import os
+import time
+import traceback
+
+# pyarrow is optional and only imported when the export is enabled (load_pyarrow)
+pa = None
+pq = None
+
+def load_pyarrow():
+    # True once pyarrow is imported, False when it is not installed
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            return False
+        pa = pyarrow
+        pq = pyarrow.parquet
+    return True
+
+class ParquetSink:
+    def __init__(self, directory, row_group_rows=50000, flush_interval=600, idle_close=900, compression='zstd'):
+        # Appends decoded BUFR columns to Parquet files laid out like the archive:
+        # <directory>/<topic>/<YYYYMMDD>/<YYYYMMDDHH>-<pid>.parquet, one file per hour and worker.
+        # Rows are buffered per file and written as one row group once row_group_rows are
+        # reached or the oldest buffered rows are flush_interval seconds old.
+        self.directory = directory
+        self.row_group_rows = int(row_group_rows)
+        self.flush_interval = float(flush_interval)
+        self.idle_close = float(idle_close)
+        self.compression = compression
+        self.partitions = {}
+        self.owner_pid = None
+        self.files_written = 0
+        self.rows_written = 0
+
+    @classmethod
+    def from_config(cls, parquet_config):
+        # Build a ParquetSink from the [Parquet] section of general_config.ini, or None when disabled
+        if str(parquet_config.get('Enabled', 'false')).lower() != 'true':
+            return None
+        if not load_pyarrow():
+            logging.error("Parquet export is enabled but pyarrow is not installed")
+            return None
+        return cls(parquet_config.get('Directory', '/opt/archive/wis2-data-analysis/parquet/'),
+                   row_group_rows=parquet_config.get('RowGroupRows', 50000),
+                   flush_interval=parquet_config.get('FlushInterval', 600),
+                   idle_close=parquet_config.get('IdleClose', 900),
+                   compression=parquet_config.get('Compression', 'zstd'))
+
+    def add(self, message, message_id, decoded_data):
+        # Buffer the rows of one decoded file (one row per subset) with the Message fields
+        if self.owner_pid != os.getpid():
+            # Buffers and writers inherited through a fork belong to the parent
+            self.partitions = {}
+            self.owner_pid = os.getpid()
+
+        row_count = decoded_data.row_count
+        if row_count:
+            publication_timestamp = message.publication_timestamp
+            arrays = {
+                'message_id': pa.array([message_id] * row_count, type=pa.int64()),
+                'publication_timestamp': pa.array([publication_timestamp] * row_count, type=pa.timestamp('ms')),
+                'data_id': pa.array([message.data_id] * row_count, type=pa.string()),
+                'wigos_station_identifier': pa.array([message.wigos_station_identifier] * row_count, type=pa.string()),
+                'message_number': pa.array(decoded_data.message_number)
+            }
+            # The typed columns and their missing-value masks are handed to Arrow as they are; the
+            # Arrow type follows the schema's type of the key, so an all-missing column is a null
+            # array of that type and every file of the same BUFRKeys.ini has the same columns
+            for key, dtype, values, mask in zip(decoded_data.schema.keys, decoded_data.schema.dtypes,
+                                                decoded_data.values, decoded_data.masks):
+                arrays[key] = pa.array(values, mask=mask, type=arrow_type(dtype))
+            table = pa.table(arrays)
+
+            file_name = f"{publication_timestamp:%Y%m%d%H}-{os.getpid()}.parquet"
+            path = os.path.join(self.directory, message.archive_directory, file_name)
+            partition = self.partitions.get(path)
+            if partition is None:
+                partition = self.partitions[path] = ParquetPartition(path)
+            partition.add(table)
+            if partition.rows >= self.row_group_rows:
+                self.write(partition)
+
+        self.flush_due()
+
+    def flush_due(self):
+        # Write the buffers that waited long enough and close the files no longer written to
+        # Called on every add and from the batch worker's idle handler, so quiet files are closed too
+        if self.owner_pid != os.getpid():
+            return
+        now = time.monotonic()
+        for path, partition in list(self.partitions.items()):
+            if partition.tables and now - partition.buffered_at >= self.flush_interval:
+                self.write(partition)
+            if not partition.tables and now - partition.written_at >= self.idle_close:
+                if partition.close():
+                    self.files_written += 1
+                del self.partitions[path]
+
+    def write(self, partition):
+        files_closed = partition.files_closed
+        try:
+            rows = partition.write(self.compression)
+            self.rows_written += rows
+            self.files_written += partition.files_closed - files_closed
+        except Exception as e:
+            logging.error("Error writing Parquet file %s, %d buffered rows dropped: %s",
+                          partition.path, sum(table.num_rows for table in partition.tables), e)
+            logging.debug(traceback.format_exc())
+            partition.tables = []
+            partition.rows = 0
+
+    def close(self):
+        # Write what is buffered and finalize every open file
+        if self.owner_pid != os.getpid():
+            return
+        for partition in self.partitions.values():
+            if partition.tables:
+                self.write(partition)
+            if partition.close():
+                self.files_written += 1
+        self.partitions = {}
+
+def arrow_type(dtype):
+    # Arrow type of a BufrSchema column type
+    if dtype == object:
+        return pa.string()
+    return pa.int64() if dtype.kind == 'i' else pa.float64()
+
+class ParquetPartition:
+    def __init__(self, path):
+        # Buffered tables and the open writer of one Parquet file
+        self.path = path
+        self.tables = []
+        self.rows = 0
+        self.writer = None
+        self.files_closed = 0
+        self.buffered_at = time.monotonic()
+        self.written_at = time.monotonic()
+
+    def add(self, table):
+        if not self.tables:
+            self.buffered_at = time.monotonic()
+        self.tables.append(table)
+        self.rows += table.num_rows
+
+    def write(self, compression):
+        # Write the buffered rows as one row group; the file is written under a .part name
+        # and renamed when closed, so readers never see a file without its footer
+        # Tables of the same BUFRKeys.ini share their schema; when the keys change (configuration
+        # reload) the file is closed and the following rows go to a new file
+        rows = 0
+        while self.tables:
+            schema = self.tables[0].schema
+            same = [table for table in self.tables if table.schema == schema]
+            if self.writer is not None and self.writer.schema != schema:
+                self.close()
+            if self.writer is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.writer = pq.ParquetWriter(self.path_part(), schema, compression=compression)
+            table = pa.concat_tables(same)
+            self.writer.write_table(table, row_group_size=table.num_rows)
+            rows += table.num_rows
+            self.tables = [table for table in self.tables if table.schema != schema]
+        self.rows = 0
+        self.written_at = time.monotonic()
+        return rows
+
+    def path_part(self):
+        return f"{self.path}.part"
+
+    def close(self):
+        # Finalize the file; False if nothing was ever written to it
+        if self.writer is None:
+            return False
+        self.writer.close()
+        self.writer = None
+        # A later writer for the same hour gets a new file instead of replacing this one
+        final_path = self.path
+        counter = 1
+        while os.path.exists(final_path):
+            final_path = self.path.replace('.parquet', f"-{counter}.parquet")
+            counter += 1
+        os.replace(self.path_part(), final_path)
+        self.files_closed += 1
+        return True
@@ -0,0 +1,55 @@
+-- Availability and latency per hour, flushed by the aggregator of DataProcessor (aggregator.py).
+-- Counts are added by every ingest instance; expected comes from the expected stations list.
+
+-- Table: public.availability_hourly_centre
+
+-- DROP TABLE IF EXISTS public.availability_hourly_centre;
+
+CREATE TABLE IF NOT EXISTS public.availability_hourly_centre
+(
+    hour timestamp without time zone NOT NULL,
+    centre_id character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    received bigint NOT NULL DEFAULT 0,
+    duplicates bigint NOT NULL DEFAULT 0,
+    expected integer NOT NULL DEFAULT 0,
+    -- Publication to receipt, in seconds; latency_buckets counts per metrics.LAG_BUCKETS bound (+Inf last)
+    latency_sum double precision NOT NULL DEFAULT 0,
+    latency_buckets bigint[] NOT NULL,
+    updated_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT availability_hourly_centre_pkey PRIMARY KEY (hour, centre_id)
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS public.availability_hourly_centre
+    OWNER to postgres;
+
+-- Table: public.availability_hourly_station
+
+-- DROP TABLE IF EXISTS public.availability_hourly_station;
+
+CREATE TABLE IF NOT EXISTS public.availability_hourly_station
+(
+    hour timestamp without time zone NOT NULL,
+    wigos_station_identifier character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    centre_id character varying(255) COLLATE pg_catalog."default",
+    received bigint NOT NULL DEFAULT 0,
+    duplicates bigint NOT NULL DEFAULT 0,
+    expected integer NOT NULL DEFAULT 0,
+    latency_sum double precision NOT NULL DEFAULT 0,
+    updated_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT availability_hourly_station_pkey PRIMARY KEY (hour, wigos_station_identifier)
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS public.availability_hourly_station
+    OWNER to postgres;
+
+CREATE INDEX IF NOT EXISTS availability_hourly_station_station_idx
+    ON public.availability_hourly_station (wigos_station_identifier, hour);
+
+-- Example: availability and dedup ratio per centre over the last day
+-- SELECT centre_id, sum(received)::float / nullif(sum(expected), 0) AS availability,
+--        sum(duplicates)::float / nullif(sum(received + duplicates), 0) AS duplicate_ratio
+-- FROM availability_hourly_centre WHERE hour >= now() - interval '1 day' GROUP BY centre_id;
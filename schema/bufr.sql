@@ -2,10 +2,15 @@
 
 -- DROP TABLE IF EXISTS public.bufr;
 
+CREATE SEQUENCE IF NOT EXISTS public.bufr_id_seq;
+
+-- Partitioned like message, on the publication_timestamp of the message each row comes from,
+-- so a day of BUFR rows is dropped together with its messages
 CREATE TABLE IF NOT EXISTS public.bufr
 (
     id integer NOT NULL DEFAULT nextval('bufr_id_seq'::regclass),
     message_id integer,
+    publication_timestamp timestamp without time zone NOT NULL,
     year integer,
     month integer,
     day integer,
@@ -23,14 +28,18 @@ CREATE TABLE IF NOT EXISTS public.bufr
     heightofbarometerabovemeansealevel double precision,
     unexpanded_descriptors character varying(255) COLLATE pg_catalog."default",
     raw_data jsonb,
-    CONSTRAINT bufr_pkey PRIMARY KEY (id),
-    CONSTRAINT bufr_message_id_fkey FOREIGN KEY (message_id)
-        REFERENCES public.message (id) MATCH SIMPLE
+    CONSTRAINT bufr_pkey PRIMARY KEY (id, publication_timestamp),
+    CONSTRAINT bufr_message_id_fkey FOREIGN KEY (message_id, publication_timestamp)
+        REFERENCES public.message (id, publication_timestamp) MATCH SIMPLE
         ON UPDATE NO ACTION
         ON DELETE NO ACTION
-)
-
-TABLESPACE pg_default;
+) PARTITION BY RANGE (publication_timestamp);
 
 ALTER TABLE IF EXISTS public.bufr
     OWNER to postgres;
+
+-- Joins from message to its BUFR rows
+CREATE INDEX IF NOT EXISTS bufr_message_id_idx
+    ON public.bufr (message_id);
+
+CREATE TABLE IF NOT EXISTS public.bufr_default PARTITION OF public.bufr DEFAULT;
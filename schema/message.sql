@@ -1,20 +1,36 @@
 -- Table: public.message
 
--- DROP TABLE IF EXISTS public.message;
+-- DROP TABLE IF EXISTS public.message CASCADE;
 
+CREATE SEQUENCE IF NOT EXISTS public.message_id_seq;
+
+-- Range partitioned by publication_timestamp, one partition per day (see partitions.sql),
+-- so time-bounded queries only read the days they ask for and retention drops whole days
 CREATE TABLE IF NOT EXISTS public.message
 (
     id integer NOT NULL DEFAULT nextval('message_id_seq'::regclass),
     topic character varying(255) COLLATE pg_catalog."default",
-    publication_timestamp timestamp without time zone,
+    publication_timestamp timestamp without time zone NOT NULL,
     insert_timestamp timestamp without time zone DEFAULT CURRENT_TIMESTAMP,
     data_id character varying(255) COLLATE pg_catalog."default",
     canonical_url character varying(255) COLLATE pg_catalog."default",
     wigos_station_identifier character varying(255) COLLATE pg_catalog."default",
-    CONSTRAINT message_pkey PRIMARY KEY (id)
-)
-
-TABLESPACE pg_default;
+    -- The partition key has to be part of every unique constraint
+    CONSTRAINT message_pkey PRIMARY KEY (id, publication_timestamp),
+    -- The same notification delivered by several brokers/caches is stored once
+    CONSTRAINT message_data_id_publication_timestamp_key UNIQUE (data_id, publication_timestamp)
+) PARTITION BY RANGE (publication_timestamp);
 
 ALTER TABLE IF EXISTS public.message
     OWNER to postgres;
+
+-- Availability per station and per centre (topic) over a time range
+CREATE INDEX IF NOT EXISTS message_wigos_station_identifier_idx
+    ON public.message (wigos_station_identifier, publication_timestamp);
+CREATE INDEX IF NOT EXISTS message_topic_idx
+    ON public.message (topic, publication_timestamp);
+
+-- Rows whose publication_timestamp has no daily partition (far past or future)
+CREATE TABLE IF NOT EXISTS public.message_default PARTITION OF public.message DEFAULT;
+
+-- Existing (unpartitioned) databases: see the migration notes at the end of partitions.sql
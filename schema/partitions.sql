@@ -0,0 +1,144 @@
+-- Daily partitions of message and bufr, and partition-drop retention.
+-- DatabaseManager.maintain_partitions() calls these routines ([Retention] in general_config.ini);
+-- they can also be run by hand or from cron:
+--   SELECT wis2_create_partitions(7);
+--   CALL wis2_drop_partitions(90);
+
+-- Create the daily partitions from days_back days ago to days_ahead days ahead
+-- Rows of a day that landed in the default partitions before its partition existed are moved
+-- into the new partitions first (a partition cannot be attached while the default holds its rows)
+-- Returns the number of partitions created
+CREATE OR REPLACE FUNCTION public.wis2_create_partitions(days_ahead integer DEFAULT 7, days_back integer DEFAULT 1)
+    RETURNS integer
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    day date;
+    parent text;
+    partition_name text;
+    attached text[];
+    created integer := 0;
+BEGIN
+    FOR day IN SELECT generate_series(current_date - days_back, current_date + days_ahead, interval '1 day')::date LOOP
+        CONTINUE WHEN to_regclass(format('public.message_p%s', to_char(day, 'YYYYMMDD'))) IS NOT NULL
+                  AND to_regclass(format('public.bufr_p%s', to_char(day, 'YYYYMMDD'))) IS NOT NULL;
+        -- One day at a time, so a failure only skips that day
+        BEGIN
+            -- No rows of that day can reach the default partitions until the new ones are attached
+            LOCK TABLE public.message_default, public.bufr_default IN EXCLUSIVE MODE;
+            attached := ARRAY[]::text[];
+            -- bufr first: its rows reference the message rows, which can only leave message_default afterwards
+            FOREACH parent IN ARRAY ARRAY['bufr', 'message'] LOOP
+                partition_name := parent || '_p' || to_char(day, 'YYYYMMDD');
+                CONTINUE WHEN to_regclass(format('public.%I', partition_name)) IS NOT NULL;
+                EXECUTE format('CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                               partition_name, parent);
+                EXECUTE format('WITH moved AS (DELETE FROM public.%I WHERE publication_timestamp >= %L AND publication_timestamp < %L RETURNING *) '
+                               'INSERT INTO public.%I SELECT * FROM moved',
+                               parent || '_default', day, day + 1, partition_name);
+                attached := array_prepend(partition_name, attached);
+            END LOOP;
+            -- message first, the foreign key of the bufr partition is checked against it
+            FOREACH partition_name IN ARRAY attached LOOP
+                EXECUTE format('ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+                               split_part(partition_name, '_p', 1), partition_name, day, day + 1);
+                created := created + 1;
+            END LOOP;
+        EXCEPTION WHEN others THEN
+            RAISE WARNING 'Could not create the partitions of %: %', day, SQLERRM;
+        END;
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+-- Drop the daily partitions older than keep_days days
+-- Each day is detached and dropped bufr first, since the bufr rows reference the message partition
+-- A procedure, so that each day is committed on its own: a single transaction holding the locks of
+-- every expired partition runs out of shared memory (max_locks_per_transaction) after a long outage.
+-- CALL it outside a transaction block. dropped returns the number of partitions dropped; the
+-- hourly rollups are kept
+DROP FUNCTION IF EXISTS public.wis2_drop_partitions(integer);
+CREATE OR REPLACE PROCEDURE public.wis2_drop_partitions(keep_days integer, INOUT dropped integer DEFAULT 0)
+    LANGUAGE plpgsql
+AS $$
+DECLARE
+    day date;
+    parent text;
+    partition_name text;
+BEGIN
+    dropped := 0;
+    FOR day IN
+        SELECT DISTINCT to_date(right(child.relname, 8), 'YYYYMMDD')
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_namespace ns ON ns.oid = child.relnamespace
+        WHERE ns.nspname = 'public'
+          AND parent.relname IN ('message', 'bufr')
+          AND child.relname ~ '_p[0-9]{8}$'
+          AND to_date(right(child.relname, 8), 'YYYYMMDD') < current_date - keep_days
+        ORDER BY 1
+    LOOP
+        -- One day at a time, so a failure only keeps that day
+        BEGIN
+            FOREACH parent IN ARRAY ARRAY['bufr', 'message'] LOOP
+                partition_name := parent || '_p' || to_char(day, 'YYYYMMDD');
+                CONTINUE WHEN to_regclass(format('public.%I', partition_name)) IS NULL;
+                EXECUTE format('ALTER TABLE public.%I DETACH PARTITION public.%I', parent, partition_name);
+                EXECUTE format('DROP TABLE public.%I', partition_name);
+                dropped := dropped + 1;
+            END LOOP;
+        EXCEPTION WHEN others THEN
+            RAISE WARNING 'Could not drop the partitions of %: %', day, SQLERRM;
+        END;
+        COMMIT;
+    END LOOP;
+END;
+$$;
+
+-- Databases already partitioned: \i partitions.sql replaces both routines; days whose rows
+-- went to message_default/bufr_default get their partitions on the next maintenance run.
+
+-- Rollups written before centre_id was the full centre (fra/meteofrance rather than fra):
+-- TRUNCATE message_hourly_centre, message_hourly_station; then run the two rollup INSERTs of the
+-- migration below (the hours still in message are rebuilt).
+
+-- Migrating an existing (unpartitioned) database:
+--   ALTER TABLE bufr RENAME TO bufr_old;
+--   ALTER TABLE message RENAME TO message_old;
+--   ALTER TABLE bufr_old RENAME CONSTRAINT bufr_pkey TO bufr_old_pkey;
+--   ALTER TABLE message_old RENAME CONSTRAINT message_pkey TO message_old_pkey;
+--   ALTER TABLE message_old RENAME CONSTRAINT message_data_id_publication_timestamp_key TO message_old_key;
+--   ALTER SEQUENCE message_id_seq OWNED BY NONE;
+--   ALTER SEQUENCE bufr_id_seq OWNED BY NONE;
+--   \i message.sql
+--   \i bufr.sql
+--   \i summary.sql
+--   \i partitions.sql
+--   SELECT wis2_create_partitions(7, (current_date - (SELECT min(publication_timestamp) FROM message_old)::date));
+--   INSERT INTO message SELECT * FROM message_old WHERE publication_timestamp IS NOT NULL;
+--   INSERT INTO bufr SELECT b.id, b.message_id, m.publication_timestamp, b.year, b.month, b.day, b.hour, b.minute,
+--       b.wigosidentifierseries, b.wigosissuerofidentifier, b.wigosissuenumber, b.wigoslocalidentifiercharacter,
+--       b.blocknumber, b.stationnumber, b.latitude, b.longitude, b.elevation,
+--       b.heightofbarometerabovemeansealevel, b.unexpanded_descriptors, b.raw_data
+--       FROM bufr_old b JOIN message_old m ON m.id = b.message_id;
+--   INSERT INTO message_hourly_centre
+--       SELECT date_trunc('hour', publication_timestamp), centre_id, count(*),
+--              coalesce(sum(extract(epoch FROM insert_timestamp - publication_timestamp)), 0),
+--              max(extract(epoch FROM insert_timestamp - publication_timestamp))
+--       FROM (SELECT *, CASE WHEN split_part(topic, '/', 1) = 'wis2'
+--                            THEN coalesce(substring(topic FROM '^wis2/(.+?)/data(?:/|$)'), split_part(topic, '/', 2))
+--                            ELSE '' END AS centre_id
+--             FROM message) message
+--       GROUP BY 1, 2;
+--   INSERT INTO message_hourly_station
+--       SELECT date_trunc('hour', publication_timestamp), wigos_station_identifier, min(centre_id), count(*),
+--              coalesce(sum(extract(epoch FROM insert_timestamp - publication_timestamp)), 0),
+--              max(extract(epoch FROM insert_timestamp - publication_timestamp))
+--       FROM (SELECT *, CASE WHEN split_part(topic, '/', 1) = 'wis2'
+--                            THEN coalesce(substring(topic FROM '^wis2/(.+?)/data(?:/|$)'), split_part(topic, '/', 2))
+--                            ELSE '' END AS centre_id
+--             FROM message) message
+--       WHERE wigos_station_identifier IS NOT NULL GROUP BY 1, 2;
+--   DROP TABLE bufr_old, message_old;
@@ -0,0 +1,51 @@
+-- Hourly rollups of the message table, maintained by DatabaseManager.insert_messages
+-- in the same statement as the message rows. Dashboards read these instead of scanning message.
+-- centre_id is the centre of the topic (e.g. fra/meteofrance, notification.topic_centre), as in
+-- the availability tables and the metrics.
+
+-- Table: public.message_hourly_centre
+
+-- DROP TABLE IF EXISTS public.message_hourly_centre;
+
+CREATE TABLE IF NOT EXISTS public.message_hourly_centre
+(
+    hour timestamp without time zone NOT NULL,
+    centre_id character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    messages bigint NOT NULL DEFAULT 0,
+    -- insert_timestamp - publication_timestamp, in seconds
+    latency_sum double precision NOT NULL DEFAULT 0,
+    latency_max double precision,
+    CONSTRAINT message_hourly_centre_pkey PRIMARY KEY (hour, centre_id)
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS public.message_hourly_centre
+    OWNER to postgres;
+
+-- Table: public.message_hourly_station
+
+-- DROP TABLE IF EXISTS public.message_hourly_station;
+
+CREATE TABLE IF NOT EXISTS public.message_hourly_station
+(
+    hour timestamp without time zone NOT NULL,
+    wigos_station_identifier character varying(255) COLLATE pg_catalog."default" NOT NULL,
+    centre_id character varying(255) COLLATE pg_catalog."default",
+    messages bigint NOT NULL DEFAULT 0,
+    latency_sum double precision NOT NULL DEFAULT 0,
+    latency_max double precision,
+    CONSTRAINT message_hourly_station_pkey PRIMARY KEY (hour, wigos_station_identifier)
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS public.message_hourly_station
+    OWNER to postgres;
+
+CREATE INDEX IF NOT EXISTS message_hourly_station_station_idx
+    ON public.message_hourly_station (wigos_station_identifier, hour);
+
+-- Example: availability and mean latency per centre over the last day
+-- SELECT centre_id, sum(messages), sum(latency_sum) / sum(messages) AS mean_latency
+-- FROM message_hourly_centre WHERE hour >= now() - interval '1 day' GROUP BY centre_id;
@@ -0,0 +1,208 @@
+# spool.py
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from queue import Empty
+
+from metrics import counter, gauge
+
+# The spool size is checked every CHECK_EVERY appends or CHECK_INTERVAL seconds
+CHECK_EVERY = 1000
+CHECK_INTERVAL = 10
+
+SPOOL_DEPTH = gauge('wis2_spool_depth', "Notifications waiting in the on-disk spool")
+SPOOL_ABOVE_HIGH_WATER = gauge('wis2_spool_above_high_water', "1 while the spool holds more than its high-water mark")
+SPOOL_REPLAYED = counter('wis2_spool_replayed_total', "Notifications delivered again after an expired lease")
+DROPPED = counter('wis2_messages_dropped_total', "Notifications dropped, by reason", ('reason',))
+
+class Spool:
+    def __init__(self, path, max_messages=1000000, high_water=800000, lease_seconds=600, poll_interval=0.2):
+        # Durable queue of notifications in a SQLite database (WAL journal):
+        # the subscriber appends, the processor leases batches and the workers ack them
+        # once stored. Leases that are not acked in time (crash, DB outage) are delivered again.
+        # The lease is renewed at each stage of a batch (submitted, picked up by a worker, files
+        # downloaded), so lease_seconds bounds the longest stage rather than the whole batch.
+        self.path = path
+        self.max_messages = int(max_messages)
+        self.high_water = int(high_water)
+        self.lease_seconds = float(lease_seconds)
+        self.poll_interval = float(poll_interval)
+
+        self.db = None
+        self.owner_pid = None
+        self.appended = 0
+        self.checked_at = time.monotonic()
+        self.above_high_water = False
+        self.leased = deque()
+
+    @classmethod
+    def from_config(cls, spool_config):
+        # Build a Spool from the [Spool] section of general_config.ini, or None when disabled
+        if str(spool_config.get('Enabled', 'false')).lower() != 'true':
+            return None
+        return cls(spool_config.get('Path', 'spool/notifications.db'),
+                   max_messages=spool_config.get('MaxMessages', 1000000),
+                   high_water=spool_config.get('HighWater', 800000),
+                   lease_seconds=spool_config.get('LeaseSeconds', 600))
+
+    def connection(self):
+        # One connection per process, opened lazily so it never crosses a fork
+        if self.owner_pid == os.getpid():
+            return self.db
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        # WAL lets the subscriber append while the processor reads; NORMAL sync survives
+        # a process crash without an fsync per notification
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                notification TEXT NOT NULL,
+                leased_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS spool_leased_until ON spool (leased_until)")
+        self.owner_pid = os.getpid()
+        self.leased = deque()
+        return self.db
+
+    def put(self, notification):
+        # Append one notification (same call as a queue, so the subscriber can write here directly)
+        self.connection().execute("INSERT INTO spool (notification) VALUES (?)", (json.dumps(notification),))
+        self.appended += 1
+        if self.appended % CHECK_EVERY == 0 or time.monotonic() - self.checked_at >= CHECK_INTERVAL:
+            self.enforce_limits()
+
+    def enforce_limits(self):
+        # Track the depth against the high-water mark and drop the oldest waiting
+        # notifications when the spool is over its size cap
+        # Runs in every subscriber process: the gauges are left to report(), called by the dispatcher only
+        self.checked_at = time.monotonic()
+        depth = self.depth()
+        if depth > self.max_messages:
+            excess = depth - self.max_messages
+            self.connection().execute("""
+                DELETE FROM spool WHERE seq IN (
+                    SELECT seq FROM spool WHERE leased_until IS NULL ORDER BY seq LIMIT ?)""", (excess,))
+            DROPPED.labels('spool_full').inc(excess)
+            logging.error("Spool full, dropped the %d oldest notifications", excess)
+            depth = self.max_messages
+
+        above = depth >= self.high_water
+        if above != self.above_high_water:
+            if above:
+                logging.warning("Spool above its high-water mark: %d notifications waiting", depth)
+            else:
+                logging.info("Spool back under its high-water mark: %d notifications waiting", depth)
+            self.above_high_water = above
+        return depth
+
+    def depth(self):
+        return self.connection().execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def report(self):
+        # Set the depth and high-water gauges and return the depth
+        # Call it from one process only: gauges pushed by several processes are summed when merged
+        depth = self.depth()
+        SPOOL_DEPTH.set(depth)
+        SPOOL_ABOVE_HIGH_WATER.set(1 if depth >= self.high_water else 0)
+        return depth
+
+    def release_all(self):
+        # Make every lease available again, e.g. on startup after a crash
+        released = self.connection().execute(
+            "UPDATE spool SET leased_until = NULL WHERE leased_until IS NOT NULL").rowcount
+        if released:
+            logging.info("Replaying %d notifications left in the spool", released)
+        self.leased.clear()
+
+    def lease(self, limit):
+        # Claim up to limit notifications that are not leased (or whose lease expired)
+        # Returns (seq, notification, replayed) tuples in arrival order
+        now = time.time()
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute("""
+                SELECT seq, notification, attempts FROM spool
+                WHERE leased_until IS NULL OR leased_until < ?
+                ORDER BY seq LIMIT ?""", (now, int(limit))).fetchall()
+            db.executemany("UPDATE spool SET leased_until = ?, attempts = attempts + 1 WHERE seq = ?",
+                           [(now + self.lease_seconds, seq) for seq, _, _ in rows])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        replayed = sum(1 for _, _, attempts in rows if attempts)
+        if replayed:
+            SPOOL_REPLAYED.inc(replayed)
+        return [(seq, tuple(json.loads(notification)), attempts > 0) for seq, notification, attempts in rows]
+
+    def renew(self, seqs):
+        # Restart the lease of notifications whose batch is still on its way to the database
+        # Returns how many leases had already expired: those notifications may have been leased
+        # again by the dispatcher and be stored twice
+        if not seqs:
+            return 0
+        now = time.time()
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            renewed = db.executemany("UPDATE spool SET leased_until = ? WHERE seq = ? AND leased_until >= ?",
+                                     [(now + self.lease_seconds, seq, now) for seq in seqs]).rowcount
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        expired = len(seqs) - renewed
+        if expired:
+            logging.warning("The lease of %d spooled notifications expired before they were stored "
+                            "(LeaseSeconds = %g); they may be delivered twice", expired, self.lease_seconds)
+        return expired
+
+    def get(self, timeout=1, batch_size=100):
+        # Next leased (seq, notification, replayed) tuple, leasing batch_size at a time
+        # Raises queue.Empty like a queue when nothing arrives before the timeout
+        deadline = time.monotonic() + timeout
+        while not self.leased:
+            self.leased.extend(self.lease(batch_size))
+            if self.leased:
+                break
+            if time.monotonic() >= deadline:
+                raise Empty
+            time.sleep(self.poll_interval)
+        return self.leased.popleft()
+
+    def ack(self, seqs):
+        # Remove notifications that have been stored (or deliberately dropped)
+        if not seqs:
+            return
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("DELETE FROM spool WHERE seq = ?", [(seq,) for seq in seqs])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        if self.owner_pid != os.getpid():
+            return
+        self.db.close()
+        self.db = None
+        self.owner_pid = None
+
+class SpooledBatch(list):
+    # A batch of notifications that remembers the spool entries to ack once it is stored,
+    # and whether some of them are delivered again (their messages may already be stored)
+    def __init__(self, notifications, spool_ids, replayed=False):
+        super().__init__(notifications)
+        self.spool_ids = list(spool_ids)
+        self.replayed = replayed
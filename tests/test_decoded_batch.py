@@ -0,0 +1,65 @@
+# test_decoded_batch.py
+import json
+
+import numpy as np
+
+from decoded_batch import BufrSchema, DecodedBatch, coerce
+
+SCHEMA = BufrSchema(('year', 'latitude', 'wigosLocalIdentifierCharacter'), ('latitude', 'elevation'),
+                    integer_keys=('year',), string_keys=('wigosLocalIdentifierCharacter',))
+
+def part(*values):
+    # (values, mask) of one BUFR message, None being missing
+    return (np.array([0 if value is None else value for value in values]),
+            np.array([value is None for value in values]))
+
+def test_schema_types_come_from_the_configuration():
+    assert SCHEMA.keys == ('year', 'latitude', 'wigosLocalIdentifierCharacter', 'elevation')
+    assert [dtype.kind for dtype in SCHEMA.dtypes] == ['i', 'f', 'O', 'f']
+
+def test_coerce_float_to_int_masks_non_finite_values():
+    values, mask = coerce(np.array([2024.0, np.nan, 1e300, 7.6]), np.array([False, False, False, True]),
+                          np.dtype(np.int64))
+    assert values.dtype == np.int64
+    assert values[0] == 2024
+    assert mask.tolist() == [False, True, True, True]
+
+def test_coerce_object_values():
+    values, mask = coerce(np.array(['1.5', 'x', None], dtype=object), np.zeros(3, dtype=bool), np.dtype(np.float64))
+    assert values[0] == 1.5
+    assert mask.tolist() == [False, True, True]
+    values, _ = coerce(np.array([12, 345]), np.zeros(2, dtype=bool), np.dtype(object))
+    assert values.tolist() == ['12', '345']
+
+def test_coerce_keeps_the_input_mask():
+    mask = np.array([False, True])
+    _, coerced = coerce(np.array([1.0, 2.0]), mask, np.dtype(np.int64))
+    assert mask.tolist() == [False, True] and coerced is not mask
+
+def test_from_parts_gives_every_file_the_same_columns():
+    # Two BUFR messages of 2 and 1 subsets; the string key is only in the second one
+    batch = DecodedBatch.from_parts(SCHEMA, [2, 1], [
+        [part(2024.0, 2024.0), part(2024.0)],
+        [part(45.5, None), part(46.5)],
+        [None, (np.array(['ABC'], dtype=object), np.array([False]))],
+        [None, None],
+    ])
+    assert batch.row_count == 3 and batch.message_count == 2
+    assert batch.message_number.tolist() == [0, 0, 1]
+    assert [values.dtype for values in batch.values] == list(SCHEMA.dtypes)
+    assert batch.column_list('year') == [2024, 2024, 2024]
+    assert batch.column_list('latitude') == [45.5, None, 46.5]
+    assert batch.column_list('wigosLocalIdentifierCharacter') == [None, None, 'ABC']
+    assert batch.column_list('elevation') == [None, None, None]
+    assert batch.column_list('unknown') == [None, None, None]
+
+def test_raw_json():
+    batch = DecodedBatch.from_parts(SCHEMA, [1], [[part(2024.0)], [part(None)],
+                                                  [(np.array(['A"B'], dtype=object), np.array([False]))], [None]])
+    assert json.loads(batch.raw_json()[0]) == {'year': 2024, 'latitude': None,
+                                               'wigosLocalIdentifierCharacter': 'A"B', 'elevation': None}
+
+def test_empty_file():
+    batch = DecodedBatch.from_parts(SCHEMA, [], [[] for _ in SCHEMA.keys])
+    assert batch.row_count == 0
+    assert batch.raw_json() == []
@@ -0,0 +1,48 @@
+# test_dedup_cache.py
+from dedup_cache import DedupCache
+
+def test_repeated_key_is_seen():
+    cache = DedupCache(max_size=10, ttl=60)
+    assert not cache.seen(('data', '2024-05-01T12:00:00Z'), now=0)
+    assert cache.seen(('data', '2024-05-01T12:00:00Z'), now=1)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_key_expires_after_ttl():
+    cache = DedupCache(max_size=10, ttl=60)
+    cache.seen('a', now=0)
+    assert not cache.seen('a', now=60)
+    assert cache.seen('a', now=61)
+
+def test_expired_entries_are_evicted():
+    cache = DedupCache(max_size=10, ttl=60)
+    cache.seen('a', now=0)
+    cache.seen('b', now=30)
+    cache.seen('c', now=70)
+    assert list(cache.entries) == ['b', 'c']
+
+def test_least_recently_seen_key_is_evicted_first():
+    cache = DedupCache(max_size=2, ttl=60)
+    cache.seen('a', now=0)
+    cache.seen('b', now=1)
+    cache.seen('a', now=2)
+    cache.seen('c', now=3)
+    assert len(cache) == 2
+    assert not cache.seen('b', now=4)
+
+def test_none_key_is_never_seen():
+    cache = DedupCache()
+    assert not cache.seen(None)
+    assert not cache.seen(None)
+    assert len(cache) == 0
+
+def test_forget():
+    cache = DedupCache()
+    cache.seen('a', now=0)
+    cache.forget('a')
+    assert not cache.seen('a', now=1)
+
+def test_notification_key():
+    notification = ('topic', 'id-1', '2024-05-01T12:00:00Z', 'data-1', 'https://example.int/f.bufr4', '0-20000-0-1')
+    assert DedupCache.notification_key(notification) == ('data-1', '2024-05-01T12:00:00Z')
+    assert DedupCache.notification_key(('topic', 'id-1', 'N/A', 'data-1')) == ('id', 'id-1')
+    assert DedupCache.notification_key(('topic', None, 'N/A', 'N/A')) is None
@@ -0,0 +1,80 @@
+# test_flush_scheduler.py
+import pytest
+
+import flush_scheduler
+from flush_scheduler import FlushScheduler
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(flush_scheduler.time, 'monotonic', fake)
+    return fake
+
+def workers(busy_seconds, messages, count=2):
+    return [{'busy_seconds': busy_seconds / count, 'messages': messages // count} for _ in range(count)]
+
+def test_flush_on_size(clock):
+    scheduler = FlushScheduler(batch_size=3, min_batch_size=1)
+    scheduler.added()
+    assert scheduler.due(0) is None
+    assert scheduler.due(2) is None
+    assert scheduler.due(3) == 'size'
+
+def test_flush_on_staleness(clock):
+    scheduler = FlushScheduler(batch_size=50, max_staleness=5, idle_timeout=1)
+    assert scheduler.timeout() == 1
+    scheduler.added()
+    clock.now += 4.5
+    assert scheduler.due(1) is None
+    assert scheduler.timeout() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert scheduler.due(1) == 'timer'
+    assert scheduler.timeout() == 0
+    scheduler.flushed()
+    assert scheduler.timeout() == 1
+
+def test_batch_size_follows_the_backlog(clock):
+    scheduler = FlushScheduler(batch_size=10, min_batch_size=10, max_batch_size=500)
+    for _ in range(20):
+        scheduler.adapt(2000, workers(0, 0))
+    assert scheduler.batch_size == 500
+    for _ in range(20):
+        scheduler.adapt(0, workers(0, 0))
+    assert scheduler.batch_size == 10
+
+def test_batch_size_moves_halfway(clock):
+    scheduler = FlushScheduler(batch_size=10, min_batch_size=10, max_batch_size=500)
+    # One batch per worker out of the backlog: 100, reached halfway from 10
+    scheduler.adapt(200, workers(0, 0))
+    assert scheduler.batch_size == 55
+
+def test_batch_size_capped_by_worker_time(clock):
+    scheduler = FlushScheduler(batch_size=10, min_batch_size=10, max_batch_size=500, target_batch_seconds=10)
+    scheduler.adapt(10000, workers(0, 0))
+    # 0.1 s per message since the last call: at most 100 messages per batch
+    for _ in range(20):
+        scheduler.adapt(10000, workers(100, 1000))
+        scheduler.last_totals = (0, 0)
+    assert scheduler.batch_size == 100
+
+def test_maybe_adapt_waits_for_the_interval(clock):
+    scheduler = FlushScheduler(batch_size=10, min_batch_size=10, adapt_interval=5)
+    calls = []
+    backlog = lambda: calls.append(1) or 1000
+    scheduler.maybe_adapt(backlog, lambda: workers(0, 0))
+    assert not calls
+    clock.now += 5
+    scheduler.maybe_adapt(backlog, lambda: workers(0, 0))
+    assert calls and scheduler.batch_size > 10
+
+def test_from_config_reads_the_former_flush_interval():
+    scheduler = FlushScheduler.from_config({'FlushInterval': '2', 'BatchSize': '1000', 'MaxBatchSize': '200'})
+    assert scheduler.max_staleness == 2
+    assert scheduler.batch_size == 200
@@ -0,0 +1,43 @@
+# test_metrics.py
+import metrics
+
+REQUESTS = metrics.counter('test_requests_total', "Requests, by status", ('status',))
+DEPTH = metrics.gauge('test_depth', "Items waiting")
+SECONDS = metrics.histogram('test_seconds', "Request duration", buckets=(1, 10))
+
+def test_merged_sums_the_children():
+    before = metrics.REGISTRY.snapshot()
+    REQUESTS.labels('ok').inc(2)
+    SECONDS.observe(0.5)
+    server = metrics.MetricsServer(0)
+    server.remote[101] = {'test_requests_total': {('ok',): 3, ('error',): 1},
+                          'test_seconds': {(): ([0, 1, 0], 5.0, 1)}}
+    server.remote[102] = {'test_requests_total': {('ok',): 4}}
+
+    merged = server.merged()
+    local = before['test_requests_total'].get(('ok',), 0)
+    assert merged['test_requests_total'][('ok',)] == local + 2 + 3 + 4
+    assert merged['test_requests_total'][('error',)] == 1
+    counts, total, count = merged['test_seconds'][()]
+    assert counts[1] == 1 and count >= 2 and total >= 5.5
+
+def test_gauge_set_in_one_process_is_not_summed():
+    DEPTH.set(7)
+    server = metrics.MetricsServer(0)
+    server.remote[101] = {'test_requests_total': {('ok',): 1}}
+    server.remote[102] = {'test_requests_total': {('ok',): 1}}
+    assert server.merged()['test_depth'][()] == 7
+
+def test_merged_does_not_change_the_snapshots():
+    server = metrics.MetricsServer(0)
+    snapshot = {'test_seconds': {(): ([1, 0, 0], 0.5, 1)}}
+    server.remote[101] = snapshot
+    server.remote[102] = {'test_seconds': {(): ([1, 0, 0], 0.5, 1)}}
+    server.merged()
+    assert snapshot['test_seconds'][()] == ([1, 0, 0], 0.5, 1)
+
+def test_render():
+    DEPTH.set(3)
+    text = metrics.MetricsServer(0).render()
+    assert "# TYPE test_depth gauge" in text
+    assert "\ntest_depth 3\n" in text
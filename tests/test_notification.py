@@ -0,0 +1,51 @@
+# test_notification.py
+from datetime import datetime
+
+import pytest
+
+from notification import compact_notification, parse_message, parse_pubtime, topic_centre
+
+@pytest.mark.parametrize('pubtime, expected', [
+    ('2024-05-01T12:00:00Z', datetime(2024, 5, 1, 12)),
+    ('2024-05-01T12:00:00.589Z', datetime(2024, 5, 1, 12, 0, 0, 589000)),
+    ('2024-05-01T12:00:00.123456789Z', datetime(2024, 5, 1, 12, 0, 0, 123456)),
+    ('2024-05-01T12:00:00,5Z', datetime(2024, 5, 1, 12, 0, 0, 500000)),
+    ('2024-05-01T14:00:00+02:00', datetime(2024, 5, 1, 12)),
+    ('2024-05-01T14:00:00+0200', datetime(2024, 5, 1, 12)),
+    ('2024-05-01T10:30:00-01:30', datetime(2024, 5, 1, 12)),
+    ('20240501T120000Z', datetime(2024, 5, 1, 12)),
+    ('2024-05-01T12:00:00', datetime(2024, 5, 1, 12)),
+])
+def test_parse_pubtime(pubtime, expected):
+    assert parse_pubtime(pubtime) == expected
+
+@pytest.mark.parametrize('pubtime', ['N/A', '', None, '2024-13-01T12:00:00Z', 'yesterday'])
+def test_parse_pubtime_rejects(pubtime):
+    assert parse_pubtime(pubtime) is None
+
+def test_topic_centre():
+    assert topic_centre('wis2/fra/meteofrance/data/core/weather/surface-based-observations/synop') == 'fra/meteofrance'
+    assert topic_centre('cache/a/wis2/de-dwd/data/core/weather') == 'de-dwd'
+    assert topic_centre('wis2/de-dwd') == 'de-dwd'
+    assert topic_centre('origin/a/other') == ''
+
+def test_compact_notification():
+    data = {'id': 'id-1',
+            'properties': {'pubtime': '2024-05-01T12:00:00Z', 'data_id': 'data-1'},
+            'links': [{'rel': 'via', 'href': 'https://example.int/via'},
+                      {'rel': 'canonical', 'href': 'https://example.int/f.bufr4'}]}
+    assert compact_notification('topic', data) == ('topic', 'id-1', '2024-05-01T12:00:00Z', 'data-1',
+                                                   'https://example.int/f.bufr4', 'N/A')
+
+def test_parse_message():
+    topic = 'cache/a/wis2/fra/meteofrance/data/core/weather/surface-based-observations/synop'
+    message = parse_message((topic, 'id-1', '2024-05-01T12:00:00Z', 'data-1', 'https://example.int/f.bufr4',
+                             '0-20000-0-1'))
+    assert message.topic == 'wis2/fra/meteofrance/data/core/weather/surface-based-observations/synop'
+    assert message.publication_timestamp == datetime(2024, 5, 1, 12)
+    assert message.archive_directory == message.topic + '/20240501'
+
+def test_parse_message_skips_images_and_rejects_bad_pubtime():
+    assert parse_message(('topic', 'id-1', '2024-05-01T12:00:00Z', 'data-1', 'https://example.int/f.PNG', 'N/A')) is None
+    with pytest.raises(ValueError):
+        parse_message(('topic', 'id-1', 'N/A', 'data-1', 'https://example.int/f.bufr4', 'N/A'))
@@ -0,0 +1,68 @@
+# test_parquet_sink.py
+import glob
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import parquet_sink
+from decoded_batch import BufrSchema, DecodedBatch
+from notification import Message
+from parquet_sink import ParquetSink
+
+parquet_sink.load_pyarrow()
+
+SCHEMA = BufrSchema(('year', 'latitude', 'wigosLocalIdentifierCharacter'), (),
+                    integer_keys=('year',), string_keys=('wigosLocalIdentifierCharacter',))
+MESSAGE = Message('wis2/a/b/c/d/e/f/synop', datetime(2024, 5, 1, 12), 'data-1', 'https://example.int/f.bufr4',
+                  '0-20000-0-1', 'wis2/a/b/c/d/e/f/synop/20240501')
+
+def decoded(schema, parts):
+    # One BUFR message of one subset; parts maps a key to its value, missing keys are absent
+    return DecodedBatch.from_parts(schema, [1], [
+        [None] if key not in parts else [(np.array([parts[key]]), np.array([False]))] for key in schema.keys])
+
+def read_rows(directory):
+    import pyarrow.parquet
+    paths = sorted(glob.glob(os.path.join(directory, '**', '*.parquet'), recursive=True))
+    return paths, [pyarrow.parquet.read_table(path) for path in paths]
+
+def test_all_missing_column_keeps_its_type(tmp_path):
+    # A file without the string key used to give a null column, and the next file's
+    # string column no longer matched the open writer's schema
+    sink = ParquetSink(str(tmp_path))
+    sink.add(MESSAGE, 1, decoded(SCHEMA, {'year': 2024.0, 'latitude': 45.5}))
+    sink.add(MESSAGE, 2, decoded(SCHEMA, {'year': 2024.0, 'latitude': 46.5, 'wigosLocalIdentifierCharacter': 'ABC'}))
+    sink.close()
+
+    paths, tables = read_rows(str(tmp_path))
+    assert len(paths) == 1 and sink.rows_written == 2
+    table = tables[0]
+    assert str(table.schema.field('year').type) == 'int64'
+    assert str(table.schema.field('wigosLocalIdentifierCharacter').type) == 'string'
+    assert table.column('wigosLocalIdentifierCharacter').to_pylist() == [None, 'ABC']
+    assert table.column('year').to_pylist() == [2024, 2024]
+
+def test_new_schema_starts_a_new_file(tmp_path):
+    sink = ParquetSink(str(tmp_path), row_group_rows=1)
+    sink.add(MESSAGE, 1, decoded(SCHEMA, {'year': 2024.0}))
+    extended = BufrSchema(SCHEMA.keys, ('elevation',), integer_keys=('year',),
+                          string_keys=('wigosLocalIdentifierCharacter',))
+    sink.add(MESSAGE, 2, decoded(extended, {'year': 2024.0, 'elevation': 10.0}))
+    sink.close()
+
+    paths, tables = read_rows(str(tmp_path))
+    assert len(paths) == 2 and sink.files_written == 2
+    assert sum(table.num_rows for table in tables) == 2
+    assert not glob.glob(os.path.join(str(tmp_path), '**', '*.part'), recursive=True)
+
+def test_flush_due_writes_and_closes_quiet_files(tmp_path):
+    sink = ParquetSink(str(tmp_path), flush_interval=0, idle_close=0)
+    sink.add(MESSAGE, 1, decoded(SCHEMA, {'year': 2024.0}))
+    sink.flush_due()
+    assert sink.partitions == {}
+    paths, tables = read_rows(str(tmp_path))
+    assert len(paths) == 1 and tables[0].num_rows == 1
@@ -0,0 +1,104 @@
+# test_spool.py
+import time
+from queue import Empty
+
+import pytest
+
+import spool
+from spool import Spool, SpooledBatch
+
+def notifications(count):
+    return [('topic', f'id-{index}', '2024-05-01T12:00:00Z', f'data-{index}', 'https://example.int/f.bufr4', 'N/A')
+            for index in range(count)]
+
+@pytest.fixture
+def queue(tmp_path):
+    created = Spool(str(tmp_path / 'spool.db'), max_messages=100, high_water=5, lease_seconds=60, poll_interval=0.01)
+    yield created
+    created.close()
+
+def test_lease_in_arrival_order(queue):
+    for notification in notifications(3):
+        queue.put(notification)
+    leased = queue.lease(2)
+    assert [notification for _, notification, _ in leased] == notifications(2)
+    assert not any(replayed for _, _, replayed in leased)
+    assert [notification for _, notification, _ in queue.lease(10)] == notifications(3)[2:]
+    assert queue.lease(10) == []
+
+def test_get_raises_empty(queue):
+    with pytest.raises(Empty):
+        queue.get(timeout=0.05)
+
+def test_ack_removes(queue):
+    for notification in notifications(2):
+        queue.put(notification)
+    queue.ack([seq for seq, _, _ in queue.lease(2)])
+    assert queue.depth() == 0
+
+def test_expired_lease_is_replayed(queue):
+    queue.lease_seconds = 0.05
+    queue.put(notifications(1)[0])
+    queue.lease(1)
+    assert queue.lease(1) == []
+    time.sleep(0.1)
+    [(_, notification, replayed)] = queue.lease(1)
+    assert notification == notifications(1)[0]
+    assert replayed
+
+def test_release_all(queue):
+    queue.put(notifications(1)[0])
+    queue.lease(1)
+    queue.release_all()
+    [(_, _, replayed)] = queue.lease(1)
+    assert replayed
+
+def test_renew(queue):
+    queue.lease_seconds = 0.5
+    queue.put(notifications(1)[0])
+    seqs = [seq for seq, _, _ in queue.lease(1)]
+    time.sleep(0.2)
+    assert queue.renew(seqs) == 0
+    # Past the first lease, within the renewed one
+    time.sleep(0.4)
+    assert queue.lease(1) == []
+    time.sleep(0.5)
+    assert queue.renew(seqs) == 1
+
+def test_oldest_waiting_dropped_over_max(queue):
+    queue.max_messages = 3
+    for notification in notifications(2):
+        queue.put(notification)
+    leased = queue.lease(1)
+    for notification in notifications(5)[2:]:
+        queue.put(notification)
+    assert queue.enforce_limits() == 3
+    # The leased notification is kept, the oldest waiting one is dropped
+    remaining = [notification for _, notification, _ in queue.lease(10)]
+    assert remaining == notifications(5)[3:]
+    queue.ack([seq for seq, _, _ in leased])
+
+def test_gauges_are_set_by_report_only(queue):
+    # Every subscriber appends: gauges set there would be summed across processes
+    spool.SPOOL_DEPTH.set(-1)
+    spool.SPOOL_ABOVE_HIGH_WATER.set(-1)
+    for notification in notifications(6):
+        queue.put(notification)
+    queue.enforce_limits()
+    assert spool.SPOOL_DEPTH.snapshot()[()] == -1
+    assert spool.SPOOL_ABOVE_HIGH_WATER.snapshot()[()] == -1
+
+    assert queue.report() == 6
+    assert spool.SPOOL_DEPTH.snapshot()[()] == 6
+    assert spool.SPOOL_ABOVE_HIGH_WATER.snapshot()[()] == 1
+
+def test_spooled_batch():
+    batch = SpooledBatch(notifications(2), iter([1, 2]), replayed=True)
+    assert list(batch) == notifications(2)
+    assert batch.spool_ids == [1, 2]
+    assert batch.replayed
+
+def test_from_config():
+    assert Spool.from_config({'Enabled': 'false'}) is None
+    created = Spool.from_config({'Enabled': 'true', 'Path': 'spool.db', 'LeaseSeconds': '30'})
+    assert created.lease_seconds == 30
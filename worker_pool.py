@@ -0,0 +1,177 @@
+# worker_pool.py
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from queue import Empty, Full
+
+from metrics import counter
+
+WORKER_RESTARTS = counter('wis2_worker_restarts_total', "Batch workers that died and were started again")
+BATCHES_LOST = counter('wis2_batches_lost_total', "Batches lost with a batch worker that died while processing them")
+
+class BatchWorkerPool:
+    SUPERVISE_INTERVAL = 1.0  # seconds between worker checks while submit() waits
+
+    def __init__(self, handler, initializer=None, finalizer=None, workers=4, max_pending=8, idle=None, idle_interval=30):
+        # Long-lived pool of batch workers fed through a bounded queue
+        # handler(batch) is called for every submitted batch inside a worker process
+        # initializer() is called once per worker, before the first batch,
+        # and finalizer() once the worker has processed its last batch
+        # idle() is called in every worker at least every idle_interval seconds, batches or not
+        # (time-based work such as writing buffers that waited too long)
+        # The dispatcher checks the workers while it submits and logs stats: a dead worker
+        # is logged with its exit code and started again at the same index
+        self.handler = handler
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.idle = idle
+        self.idle_interval = float(idle_interval)
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+
+        # The bounded queue caps in-flight work: at most max_pending batches wait
+        # while each worker holds one, so submit() blocks once everybody is busy
+        self.batch_queue = multiprocessing.Queue(maxsize=self.max_pending)
+
+        # Per-worker throughput counters, each written only by its own worker
+        self.batch_counters = [multiprocessing.RawValue('q', 0) for _ in range(self.workers)]
+        self.message_counters = [multiprocessing.RawValue('q', 0) for _ in range(self.workers)]
+        self.error_counters = [multiprocessing.RawValue('q', 0) for _ in range(self.workers)]
+        self.busy_seconds = [multiprocessing.RawValue('d', 0.0) for _ in range(self.workers)]
+        # Size of the batch each worker is processing (0 while it waits for one)
+        self.current_batch = [multiprocessing.RawValue('q', 0) for _ in range(self.workers)]
+
+        self.processes = []
+
+    def start(self):
+        # Start the worker processes once; they live until stop() is called
+        self.processes = [self._start_worker(index) for index in range(self.workers)]
+        logging.info("Started %d batch workers (max %d pending batches)", self.workers, self.max_pending)
+
+    def _start_worker(self, index):
+        process = multiprocessing.Process(target=self._run, args=(index,), name=f"batch-worker-{index}")
+        process.start()
+        return process
+
+    def check_workers(self):
+        # Start again any worker that died (killed, out of memory, crash in a C extension...)
+        # Without this, submit() blocks forever once every worker is gone
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            lost = self.current_batch[index].value
+            logging.error("Batch worker %d died with exit code %s%s, starting it again", index, process.exitcode,
+                          f" while processing a batch of {lost} messages" if lost else "")
+            if lost:
+                BATCHES_LOST.inc()
+                self.error_counters[index].value += 1
+                self.current_batch[index].value = 0
+            WORKER_RESTARTS.inc()
+            self.processes[index] = self._start_worker(index)
+
+    def submit(self, batch, timeout=None):
+        # Hand a batch to the pool, blocking while the pending queue is full (backpressure)
+        # Returns False if the batch could not be queued before the timeout
+        if not batch:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Wait in short steps so that dead workers are noticed while the queue stays full
+            self.check_workers()
+            wait = self.SUPERVISE_INTERVAL if deadline is None else min(self.SUPERVISE_INTERVAL, deadline - time.monotonic())
+            try:
+                self.batch_queue.put(batch, timeout=max(0.0, wait))
+                return True
+            except Full:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+
+    def stop(self, timeout=None):
+        # Let the workers finish everything already queued, then wait for them to exit
+        # (dead workers are replaced first, or nobody would take their stop sentinel)
+        self.check_workers()
+        for _ in self.processes:
+            self.batch_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning("Batch worker %s did not stop in time, terminating it", process.name)
+                process.terminate()
+                process.join()
+        self.processes = []
+        logging.info("Batch workers stopped")
+
+    def signal_workers(self, signum):
+        # Forward a signal (e.g. SIGHUP for a configuration reload) to every worker
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stats(self):
+        # Snapshot of the per-worker throughput counters
+        stats = []
+        for index in range(self.workers):
+            busy = self.busy_seconds[index].value
+            messages = self.message_counters[index].value
+            stats.append({
+                'worker': index,
+                'batches': self.batch_counters[index].value,
+                'messages': messages,
+                'errors': self.error_counters[index].value,
+                'busy_seconds': busy,
+                'messages_per_second': messages / busy if busy > 0 else 0.0
+            })
+        return stats
+
+    def log_stats(self):
+        self.check_workers()
+        for worker in self.stats():
+            logging.info("Batch worker %d: %d batches, %d messages, %d errors, %.1f msg/s busy",
+                         worker['worker'], worker['batches'], worker['messages'],
+                         worker['errors'], worker['messages_per_second'])
+
+    def _run(self, index):
+        # Worker loop: the parent process handles interruption and shutdown
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        if self.initializer is not None:
+            self.initializer()
+
+        last_idle_time = time.monotonic()
+        while True:
+            try:
+                batch = self.batch_queue.get(timeout=self.idle_interval if self.idle is not None else None)
+            except Empty:
+                batch = ()
+            if self.idle is not None and time.monotonic() - last_idle_time >= self.idle_interval:
+                last_idle_time = time.monotonic()
+                try:
+                    self.idle()
+                except Exception as e:
+                    logging.error("Error in idle handler of worker %d: %s", index, e)
+                    logging.debug(traceback.format_exc())
+            if batch is None:
+                break
+            if not batch:
+                continue
+
+            start_time = time.monotonic()
+            self.current_batch[index].value = len(batch)
+            try:
+                self.handler(batch)
+            except Exception as e:
+                self.error_counters[index].value += 1
+                logging.error("Error processing batch in worker %d: %s", index, e)
+                logging.debug(traceback.format_exc())
+            self.current_batch[index].value = 0
+
+            self.busy_seconds[index].value += time.monotonic() - start_time
+            self.batch_counters[index].value += 1
+            self.message_counters[index].value += len(batch)
+
+        if self.finalizer is not None:
+            self.finalizer()